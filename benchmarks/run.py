@@ -0,0 +1,138 @@
+"""run the benchmark suite, compare against a json baseline
+
+    python benchmarks/run.py                   # compare with baseline.json
+    python benchmarks/run.py --save            # record a new baseline
+    python benchmarks/run.py -k routing -t 0.1
+
+exits with status 1 when a scenario is slower, or allocates more, than
+the baseline by more than the threshold
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(here), here]
+
+from scenarios import scenarios  # noqa: E402
+
+
+def call(app, make_environ):
+    status = []
+
+    def start_response(code, headers, exc_info=None):
+        status.append(code)
+
+    chunks = app(make_environ(), start_response)
+    try:
+        for chunk in chunks:
+            pass
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    if not status or status[0][0] not in '23':
+        raise AssertionError('unexpected status %s' % status)
+
+
+def measure(app, make_environ, duration=1.0, repeat=3, allocations=20):
+    """best ops/sec of `repeat` rounds, and the peak bytes allocated
+    by a request"""
+    for _ in range(50):
+        call(app, make_environ)
+
+    best = 0
+    for _ in range(repeat):
+        count, start = 0, time.perf_counter()
+        deadline = start + duration / repeat
+        while True:
+            for _ in range(10):
+                call(app, make_environ)
+            count += 10
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+        best = max(best, count / (now - start))
+
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(allocations):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            call(app, make_environ)
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+    return {'ops': round(best, 1), 'alloc_bytes': sorted(peaks)[len(peaks) // 2]}
+
+
+def compare(results, baseline, threshold):
+    "names of the scenarios regressing past threshold"
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['ops'] < base['ops'] * (1 - threshold) or \
+                result['alloc_bytes'] > base['alloc_bytes'] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='klar benchmarks')
+    parser.add_argument('-k', dest='pattern', default='',
+                        help='only scenarios containing pattern')
+    parser.add_argument('-b', '--baseline',
+                        default=os.path.join(here, 'baseline.json'))
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='allowed regression, 0.2 for 20%%')
+    parser.add_argument('-d', '--duration', type=float, default=1.0,
+                        help='seconds per scenario')
+    parser.add_argument('--save', action='store_true',
+                        help='write results as the new baseline')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)['scenarios']
+
+    results = {}
+    print('%-22s %12s %10s %12s %10s' % (
+        'scenario', 'ops/sec', 'change', 'alloc bytes', 'change'))
+    for name, setup in scenarios.items():
+        if args.pattern not in name:
+            continue
+        results[name] = result = measure(*setup(), duration=args.duration)
+        base = baseline.get(name)
+        print('%-22s %12.1f %10s %12d %10s' % (
+            name, result['ops'],
+            '%+.1f%%' % ((result['ops'] / base['ops'] - 1) * 100)
+            if base else '-',
+            result['alloc_bytes'],
+            '%+.1f%%' % ((result['alloc_bytes'] / base['alloc_bytes'] - 1)
+                         * 100) if base and base['alloc_bytes'] else '-'))
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as fp:
+            json.dump({'python': sys.version.split()[0],
+                       'scenarios': baseline}, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print('regressed past %d%%: %s' % (args.threshold * 100,
+                                            ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""request hot paths driven in-process, every scenario returns an app
+and a function building a fresh environ for each request"""
+
+import os
+import json
+import atexit
+import shutil
+import tempfile
+from io import BytesIO
+from urllib import parse
+
+from klar import App
+
+scenarios = {}
+
+
+def scenario(fn):
+    scenarios[fn.__name__] = fn
+    return fn
+
+
+def environ(path, method='GET', query=None, body=b'', content_type='',
+            headers=None):
+    base = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': parse.urlencode(query or {}),
+        'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': content_type,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+    }
+    for key, value in (headers or {}).items():
+        base['HTTP_' + key.replace('-', '_').upper()] = value
+
+    def make():
+        env = base.copy()
+        env['wsgi.input'] = BytesIO(body)
+        return env
+    return make
+
+
+def routing(count):
+    app = App()
+    for i in range(count):
+        app.get('/resource%d/<id>' % i, lambda id: id)
+    return app, environ('/resource%d/42' % (count - 1))
+
+
+@scenario
+def routing_10():
+    return routing(10)
+
+
+@scenario
+def routing_100():
+    return routing(100)
+
+
+@scenario
+def routing_1000():
+    return routing(1000)
+
+
+@scenario
+def injection():
+    app = App()
+    app.provide('settings', lambda: {'db': 'memory'})
+    app.provide('db', lambda settings: {})
+    app.provide('repo', lambda db: db, on_request=True)
+    app.provide('user', lambda req, repo: 'anonymous', on_request=True)
+    app.provide('audit', lambda user, logger: [], on_request=True)
+    app.provide('service', lambda repo, user, audit, cache: user,
+                on_request=True)
+
+    @app.get('/users/<id>')
+    def show(id: int, service, repo, user, audit, req, res, cookies):
+        return service
+
+    return app, environ('/users/42', headers={'Cookie': 'a=1; b=2'})
+
+
+def json_body(items):
+    app = App()
+    schema = {'type': 'object', 'properties': {
+        'items': {'type': 'array', 'items': {
+            'type': 'object', 'properties': {
+                'id': {'type': 'integer'}, 'name': {'type': 'string'}},
+            'required': ['id', 'name']}}}}
+
+    @app.post('/items')
+    def create(body: schema):
+        return {'count': len(body['items'])}
+
+    body = json.dumps({'items': [{'id': i, 'name': 'item %d' % i}
+                                 for i in range(items)]}).encode()
+    return app, environ('/items', 'POST', body=body,
+                        content_type='application/json')
+
+
+@scenario
+def json_body_small():
+    return json_body(1)
+
+
+@scenario
+def json_body_large():
+    return json_body(1000)
+
+
+@scenario
+def form_body():
+    app = App()
+
+    @app.post('/form')
+    def submit(body):
+        return body['field0']
+
+    body = parse.urlencode({'field%d' % i: 'value %d' % i
+                            for i in range(20)}).encode()
+    return app, environ('/form', 'POST', body=body,
+                        content_type='application/x-www-form-urlencoded')
+
+
+@scenario
+def multipart_body():
+    app = App()
+
+    @app.post('/upload')
+    def upload(uploads):
+        return str(len(uploads['file'].file.read()))
+
+    boundary = 'klarbenchmarkboundary'
+    body = (('--%s\r\nContent-Disposition: form-data; name="name"\r\n\r\n'
+             'report\r\n--%s\r\nContent-Disposition: form-data; '
+             'name="file"; filename="report.bin"\r\n'
+             'Content-Type: application/octet-stream\r\n\r\n'
+             % (boundary, boundary)).encode() + b'x' * 65536 +
+            ('\r\n--%s--\r\n' % boundary).encode())
+    return app, environ('/upload', 'POST', body=body,
+                        content_type='multipart/form-data; boundary=%s'
+                        % boundary)
+
+
+@scenario
+def session_cookies():
+    app = App()
+
+    @app.get('/visit')
+    def visit(session, cookies):
+        session.set('visits', session.get('visits', 0) + 1)
+        cookies.set('last', 'now')
+        return str(session.get('visits'))
+
+    return app, environ('/visit', headers={
+        'Cookie': 'ksid=benchmarksession0; theme=dark'})
+
+
+@scenario
+def json_response_large():
+    app = App()
+    items = [{'id': i, 'name': 'item %d' % i, 'tags': ['a', 'b'],
+              'price': i * 1.5, 'active': i % 2 == 0} for i in range(1000)]
+
+    @app.get('/items')
+    def query():
+        return items
+
+    return app, environ('/items')
+
+
+@scenario
+def static_file():
+    root = tempfile.mkdtemp(prefix='klar-bench-')
+    atexit.register(shutil.rmtree, root, True)
+    with open(os.path.join(root, 'app.js'), 'w') as fp:
+        fp.write('var x = 1;\n' * 3000)
+    app = App()
+    app.static('/static/', root)
+    return app, environ('/static/app.js')
+
+
+@scenario
+def template():
+    import templates.page
+    app = App()
+    content = '<p>%s</p>' % ('lorem ipsum & dolor ' * 200)
+
+    @app.get('/page')
+    def page() -> templates.page:
+        return {'title': 'klar <benchmark>', 'content': content,
+                'items': list(range(50))}
+
+    return app, environ('/page')
@@ -1,6 +1,7 @@
 from .klar import *
 from .importers import JsonImporter, YamlImporter
 from .importers import SimpleTemplateImporter, MustacheImporter
+from .importers import JinjaImporter
 from .importers import ConfigImporter
 from .importers import install
 
@@ -8,4 +9,5 @@ install(JsonImporter(ext=".json"))
 install(YamlImporter(ext=".yaml"))
 install(SimpleTemplateImporter(ext=".html"))
 install(MustacheImporter(ext=".mustache"))
+install(JinjaImporter(ext=".jinja"))
 install(ConfigImporter(ext=".ini"))
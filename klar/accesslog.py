@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from queue import Queue, Full, Empty
+
+from .klar import on_close, capture_status, status_code
+
+
+class AccessLog:
+    """json lines access log, entries are queued and written in batches
+    by a background thread, when `max_queue` entries are waiting new ones
+    are dropped and counted
+
+    `rate` samples requests, `routes` maps route patterns to their own
+    rate, responses with a 5xx status are always logged
+    """
+
+    def __init__(self, target=None, rate=1.0, routes=None, batch_size=100,
+                 max_queue=10000, interval=1.0, header='X-Request-Id'):
+        self.target = sys.stderr if target is None else target
+        self.rate = rate
+        self.routes = routes or {}
+        self.batch_size = batch_size
+        self.interval = interval
+        self.header = header
+        self.environ_key = 'HTTP_' + header.replace('-', '_').upper()
+        self.queue = Queue(max_queue)
+        self.local = threading.local()
+        self.dropped = 0
+        self.written = 0
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def middleware(self, app):
+        def log(environ, start_response):
+            start = time.perf_counter()
+            request_id = environ.get(self.environ_key) or os.urandom(8).hex()
+            environ['klar.request_id'] = self.local.request_id = request_id
+            status = []
+            try:
+                chunks = app(environ, capture_status(
+                    start_response, status, (self.header, request_id)))
+            finally:
+                self.local.request_id = None
+            return on_close(chunks, lambda size: self.access(
+                environ, status, start, size))
+        return log
+
+    def access(self, environ, status, start, size):
+        code = status_code(status)
+        route = environ.get('klar.route')
+        rate = self.routes.get(route, self.rate)
+        if code < 500 and rate < 1 and random.random() >= rate:
+            return
+        try:
+            request_size = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            request_size = 0
+        self.put({
+            'type': 'access',
+            'time': time.time(),
+            'request_id': environ.get('klar.request_id'),
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO'),
+            'route': route,
+            'status': code,
+            'duration_ms': round((time.perf_counter() - start) * 1000, 3),
+            'request_size': request_size,
+            'response_size': size,
+            'remote_addr': environ.get('REMOTE_ADDR'),
+        })
+
+    def put(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)))
+                except Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception:
+                self.dropped += len(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def write(self, batch):
+        lines = ''.join(json.dumps(entry, separators=(',', ':'),
+                                   default=str) + '\n' for entry in batch)
+        if isinstance(self.target, str):
+            with open(self.target, 'a') as fp:
+                fp.write(lines)
+        else:
+            self.target.write(lines)
+            self.target.flush()
+        self.written += len(batch)
+
+    def flush(self):
+        "wait until every queued entry is written"
+        self.queue.join()
+
+    def stats(self):
+        return {'depth': self.queue.qsize(), 'written': self.written,
+                'dropped': self.dropped}
+
+    def handler(self, level=logging.WARNING):
+        "a logging handler queuing records as `error` entries"
+        return QueueLogHandler(self, level)
+
+
+class QueueLogHandler(logging.Handler):
+    "formats records in the caller, writing is left to the access log"
+
+    def __init__(self, log, level):
+        super().__init__(level)
+        self.log = log
+
+    def emit(self, record):
+        try:
+            entry = {
+                'type': 'log',
+                'time': record.created,
+                'request_id': getattr(self.log.local, 'request_id', None),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+            }
+            if record.exc_info:
+                entry['exception'] = logging.Formatter().formatException(
+                    record.exc_info)
+            self.log.put(entry)
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,174 @@
+import time
+import itertools
+import threading
+
+from .klar import on_close
+
+
+def default_priority(environ, critical=('/health',)):
+    "0 for health checks, 1 for authenticated requests, 2 for the rest"
+    if environ.get('PATH_INFO') in critical:
+        return 0
+    if environ.get('HTTP_AUTHORIZATION'):
+        return 1
+    return 2
+
+
+class Waiter:
+
+    def __init__(self, priority, order, route):
+        self.priority = priority
+        self.order = order
+        self.route = route
+        self.admitted = threading.Event()
+        self.rejected = False
+
+    def key(self):
+        return self.priority, self.order
+
+
+class Admission:
+    """limits requests in flight, `limit` globally and `routes` per route
+    pattern, requests over the limit wait up to `timeout` seconds in a
+    queue of `max_queue`, lower `priority(environ)` goes first, the
+    others get 503 with `Retry-After`
+
+    with `target_ms` the global limit adapts to latency, shrinking by
+    `backoff` when the average latency of a window of requests exceeds
+    the target and growing by one otherwise, within `min_limit` and
+    `limit`
+    """
+
+    def __init__(self, limit=64, routes=None, max_queue=128, timeout=1.0,
+                 priority=default_priority, retry_after=1, target_ms=None,
+                 min_limit=1, window=100, backoff=0.9, router=None):
+        self.max_limit = limit
+        self.limit = limit
+        self.routes = routes or {}
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.priority = priority
+        self.retry_after = str(retry_after)
+        self.target = target_ms / 1000 if target_ms else None
+        self.min_limit = min_limit
+        self.window = window
+        self.backoff = backoff
+        self.router = router
+        self.lock = threading.Lock()
+        self.order = itertools.count()
+        self.waiters = []
+        self.in_flight = 0
+        self.route_in_flight = {}
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def middleware(self, app):
+        def admit(environ, start_response):
+            route = self.route_of(environ) if self.routes else None
+            if not self.acquire(environ, route):
+                start_response('503 Service Unavailable', [
+                    ('Content-Type', 'text/plain; charset=utf-8'),
+                    ('Retry-After', self.retry_after)])
+                return [b'Service Unavailable']
+            start = time.perf_counter()
+            try:
+                chunks = app(environ, start_response)
+            except Exception:
+                self.release(route, start)
+                raise
+            return on_close(chunks, lambda size: self.release(route, start))
+        return admit
+
+    def route_of(self, environ):
+        handler, _ = self.router.match(environ.get('REQUEST_METHOD', 'GET'),
+                                       environ.get('PATH_INFO', '/'))
+        return self.router.patterns.get(handler)
+
+    def available(self, route):
+        if self.in_flight >= self.limit:
+            return False
+        limit = self.routes.get(route)
+        return limit is None or self.route_in_flight.get(route, 0) < limit
+
+    def start(self, route):
+        self.in_flight += 1
+        if route in self.routes:
+            self.route_in_flight[route] = \
+                self.route_in_flight.get(route, 0) + 1
+        self.admitted += 1
+
+    def acquire(self, environ, route):
+        "admit a request, or wait for a slot, False when rejected"
+        with self.lock:
+            if not self.waiters and self.available(route):
+                self.start(route)
+                return True
+            waiter = Waiter(self.priority(environ), next(self.order), route)
+            if len(self.waiters) >= self.max_queue:
+                lowest = max(self.waiters, key=Waiter.key)
+                if lowest.key() < waiter.key():
+                    self.rejected += 1
+                    return False
+                # a request of higher priority takes the place of the lowest
+                self.waiters.remove(lowest)
+                lowest.rejected = True
+                lowest.admitted.set()
+            self.waiters.append(waiter)
+            self.dispatch()
+        if waiter.admitted.wait(self.timeout) and not waiter.rejected:
+            return True
+        with self.lock:
+            if waiter.admitted.is_set() and not waiter.rejected:
+                return True
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+                self.timed_out += 1
+            self.rejected += 1
+            return False
+
+    def dispatch(self):
+        "admit waiters in priority order while there is room"
+        for waiter in sorted(self.waiters, key=Waiter.key):
+            if self.in_flight >= self.limit:
+                break
+            if self.available(waiter.route):
+                self.waiters.remove(waiter)
+                self.start(waiter.route)
+                waiter.admitted.set()
+
+    def release(self, route, start):
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.in_flight -= 1
+            if route in self.routes:
+                self.route_in_flight[route] -= 1
+            if self.target is not None:
+                self.adapt(latency)
+            if self.waiters:
+                self.dispatch()
+
+    def adapt(self, latency):
+        self.latency_sum += latency
+        self.latency_count += 1
+        if self.latency_count < self.window:
+            return
+        average = self.latency_sum / self.latency_count
+        self.latency_sum, self.latency_count = 0.0, 0
+        if average > self.target:
+            self.limit = max(self.min_limit, int(self.limit * self.backoff))
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'queued': len(self.waiters),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
@@ -0,0 +1,311 @@
+"""command line interface
+
+    klar bench myapp:app -c 8 -d 10 --scenario requests.json
+    klar bench myapp:app --replay traffic.jsonl --json
+    klar bench --url http://localhost:8000 --scenario requests.json
+    klar replay traffic.jsonl myapp:app --speed 10
+"""
+
+import io
+import sys
+import json
+import time
+import argparse
+import itertools
+import threading
+import importlib
+from urllib import parse
+from http.client import HTTPConnection
+from wsgiref.simple_server import WSGIRequestHandler, ServerHandler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='klar')
+    commands = parser.add_subparsers(dest='command')
+
+    bench = commands.add_parser(
+        'bench', help='drive an app over http, report latency percentiles')
+    bench.add_argument('app', nargs='?',
+                       help='app to serve on localhost, as module:attribute')
+    bench.add_argument('--url', help='bench a server already running')
+    bench.add_argument('--server', choices=['simple', 'threaded'],
+                       default='threaded', help='wsgiref server mode')
+    bench.add_argument('--scenario', help='json list of requests, '
+                       '{method, path, body, headers, weight}')
+    bench.add_argument('--replay', help='recorded traffic, json lines')
+    bench.add_argument('-c', '--concurrency', type=int, default=4)
+    bench.add_argument('-n', '--requests', type=int,
+                       help='stop after this many requests')
+    bench.add_argument('-d', '--duration', type=float, default=5,
+                       help='seconds to run, unless -n is given')
+    bench.add_argument('--json', action='store_true',
+                       help='print the report as json')
+
+    replay = commands.add_parser(
+        'replay', help='replay recorded traffic, compare with the recording')
+    replay.add_argument('recording', help='file written by app.record')
+    replay.add_argument('app', nargs='?',
+                        help='app to call in-process, as module:attribute')
+    replay.add_argument('--url', help='replay over http against a server')
+    replay.add_argument('--speed', type=float, default=1.0,
+                        help='pace relative to the recording, 0 for '
+                        'as fast as possible')
+    replay.add_argument('-c', '--concurrency', type=int, default=8)
+    replay.add_argument('--json', action='store_true',
+                        help='print the comparison as json')
+
+    args = parser.parse_args(argv)
+    if args.command == 'bench':
+        if not args.app and not args.url:
+            parser.error('bench needs an app or --url')
+        return run_bench(args)
+    if args.command == 'replay':
+        if not args.app and not args.url:
+            parser.error('replay needs an app or --url')
+        return run_replay(args)
+    parser.print_help()
+    return 2
+
+
+def load_app(spec):
+    "import `module:attribute`"
+    module, _, attribute = spec.partition(':')
+    sys.path.insert(0, '.')
+    try:
+        return getattr(importlib.import_module(module), attribute or 'app')
+    finally:
+        sys.path.remove('.')
+
+
+def load_requests(scenario=None, replay=None):
+    "requests as dicts with method, path, body and headers"
+    if replay:
+        with open(replay) as fp:
+            requests = [json.loads(line) for line in fp if line.strip()]
+    elif scenario:
+        with open(scenario) as fp:
+            requests = json.load(fp)
+        if isinstance(requests, dict):
+            requests = requests['requests']
+    else:
+        requests = [{'method': 'GET', 'path': '/'}]
+    expanded = []
+    for request in requests:
+        body = request.get('body')
+        headers = dict(request.get('headers') or {})
+        if body is not None and not isinstance(body, str):
+            body = json.dumps(body)
+            headers.setdefault('Content-Type', 'application/json')
+        path = request.get('path', '/')
+        if request.get('query'):
+            query = request['query']
+            path += '?' + (query if isinstance(query, str)
+                           else parse.urlencode(query))
+        expanded += [(request.get('method', 'GET').upper(), path,
+                      body.encode() if body else None, headers)
+                     ] * int(request.get('weight', 1))
+    return expanded
+
+
+def run_bench(args):
+    requests = load_requests(args.scenario, args.replay)
+    server = None
+    if args.url:
+        url = parse.urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        app = load_app(args.app)
+        threaded = args.server == 'threaded'
+        server = app.server('127.0.0.1', 0, threaded)
+        # a single threaded server can't hold a connection per client
+        server.RequestHandlerClass = KeepAliveHandler if threaded \
+            else QuietHandler
+        host, port = server.server_address
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        report = bench(host, port, requests, args.concurrency,
+                       args.requests, None if args.requests else args.duration)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+    return 0
+
+
+def run_replay(args):
+    from .replay import replay, diff, format_diff
+    results = replay(args.recording,
+                     app=None if args.url else load_app(args.app),
+                     url=args.url, speed=args.speed or None,
+                     concurrency=args.concurrency)
+    report = diff(results)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_diff(report))
+    return 1 if report['mismatches'] or report['errors'] else 0
+
+
+class QuietHandler(WSGIRequestHandler):
+    "wsgiref request handler without access logging"
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveHandler(QuietHandler):
+    """serves the requests of a connection until the client closes it,
+    responses without Content-Length end the connection"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        self.close_connection = False
+        while not self.close_connection:
+            self.handle_one()
+
+    def handle_one(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = self.request_version = self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        environ = self.get_environ()
+        # read the body up front, whatever the app leaves of it would be
+        # taken for the next request
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = io.BytesIO(self.rfile.read(length) if length > 0 else b'')
+        handler = KeepAliveServerHandler(body, self.wfile, self.get_stderr(),
+                                         environ, multithread=False)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+class KeepAliveServerHandler(ServerHandler):
+
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        if 'Content-Length' not in self.headers:
+            self.headers['Connection'] = 'close'
+        if self.headers.get('Connection', '').lower() == 'close':
+            self.request_handler.close_connection = True
+        elif self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+def bench(host, port, requests, concurrency=4, total=None, duration=None):
+    """send `requests` in turn over `concurrency` keep-alive
+    connections, until `total` requests are sent or `duration` passes,
+    `connections` counts the connections opened, more than
+    `concurrency` when the server closes them"""
+    lock = threading.Lock()
+    latencies, statuses, errors = [], {}, []
+    connections = itertools.count()
+    sent = itertools.count()
+    deadline = time.perf_counter() + duration if duration else None
+
+    def next_request():
+        with lock:
+            index = next(sent)
+        if total is not None and index >= total or \
+                deadline is not None and time.perf_counter() >= deadline:
+            return None
+        return requests[index % len(requests)]
+
+    def worker():
+        connection = HTTPConnection(host, port, timeout=30)
+        while True:
+            request = next_request()
+            if request is None:
+                break
+            method, path, body, headers = request
+            start = time.perf_counter()
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    next(connections)
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+                if response.getheader('Connection', '').lower() == 'close':
+                    connection.close()
+            except Exception as e:
+                connection.close()
+                with lock:
+                    errors.append(type(e).__name__)
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+        connection.close()
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    report = summarize(latencies, statuses, errors,
+                       time.perf_counter() - started)
+    report['connections'] = next(connections)
+    return report
+
+
+def percentile(ordered, p):
+    "nearest-rank percentile of sorted values"
+    if not ordered:
+        return None
+    rank = max(int(-(-p * len(ordered) // 100)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(latencies, statuses, errors, elapsed):
+    ordered = sorted(latencies)
+    count = len(ordered) + len(errors)
+    failed = len(errors) + sum(n for status, n in statuses.items()
+                               if status >= 500)
+    return {
+        'requests': count,
+        'seconds': round(elapsed, 3),
+        'throughput': round(count / elapsed, 1) if elapsed else 0,
+        'latency_ms': {
+            name: round(percentile(ordered, p) * 1000, 3) if ordered else None
+            for name, p in (('p50', 50), ('p90', 90), ('p99', 99),
+                            ('p99.9', 99.9))},
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+        'errors': len(errors),
+        'error_rate': round(failed / count, 4) if count else 0,
+    }
+
+
+def format_report(report):
+    latency = report['latency_ms']
+    lines = [
+        'requests    %d in %.2fs' % (report['requests'], report['seconds']),
+        'throughput  %.1f req/s' % report['throughput'],
+        'latency     ' + '  '.join(
+            '%s %s' % (name, '-' if latency[name] is None
+                       else '%.2fms' % latency[name])
+            for name in ('p50', 'p90', 'p99', 'p99.9')),
+        'statuses    ' + ('  '.join('%s: %d' % item for item in
+                                    report['statuses'].items()) or '-'),
+        'errors      %d (error rate %.2f%%)' % (
+            report['errors'], report['error_rate'] * 100),
+    ]
+    if 'connections' in report:
+        lines.append('connections %d' % report['connections'])
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,31 +1,60 @@
 import os
 import sys
-import imp
 import types
+from string import Template
+from importlib.machinery import ModuleSpec
 
 
 class Finder:
+    """a single meta path finder for all installed importers,
+    directory listings are cached and refreshed when a directory's
+    mtime changes, like `FileFinder` does"""
+
+    def __init__(self):
+        self.importers = {}
+        self.listings = {}
+
+    def find_spec(self, fullname, path=None, target=None):
+        name = fullname.rpartition('.')[2]
+        for dirname in sys.path if path is None else path:
+            entries = self.listing(dirname or '.')
+            for ext, importer in self.importers.items():
+                if name + ext in entries:
+                    spec = ModuleSpec(fullname, importer, origin=os.path.join(
+                        dirname, name + ext))
+                    spec.has_location = True
+                    return spec
+
+    def listing(self, dirname):
+        try:
+            mtime = os.stat(dirname).st_mtime_ns
+        except OSError:
+            return ()
+        cached = self.listings.get(dirname)
+        if cached is None or cached[0] != mtime:
+            try:
+                cached = mtime, set(os.listdir(dirname))
+            except OSError:
+                cached = mtime, set()
+            self.listings[dirname] = cached
+        return cached[1]
+
+    def invalidate_caches(self):
+        self.listings.clear()
+
+
+finder = Finder()
+
+
+class BaseImporter:
     def __init__(self, ext):
         self.ext = ext
 
-    def find_module(self, fullname, path):
-        for dirname in sys.path:
-            filename = os.path.join(dirname, *(fullname.split('.'))) + self.ext
-            if os.path.exists(filename):
-                self.filename = filename
-                return self
-
+    def create_module(self, spec):
+        return None
 
-class BaseImporter(Finder):
-    def load_module(self, fullname):
-        if fullname in sys.modules:
-            mod = sys.modules[fullname]
-        else:
-            sys.modules[fullname] = mod = imp.new_module(fullname)
-            mod.__file__ = self.filename
-            mod.__loader__ = self
-            exec(self.get_source(self.filename), mod.__dict__)
-        return mod
+    def exec_module(self, mod):
+        exec(self.get_source(mod.__file__), mod.__dict__)
 
 
 class TemplateModule(types.ModuleType):
@@ -33,51 +62,92 @@ class TemplateModule(types.ModuleType):
         return self.__call__(kvs)
 
 
-class TemplateImporter(Finder):
-    def load_module(self, fullname):
-        if fullname in sys.modules:
-            mod = sys.modules[fullname]
-        else:
-            sys.modules[fullname] = mod = TemplateModule(fullname)
-            mod.__file__ = self.filename
-            mod.__loader__ = self
-            exec(self.get_source(self.filename), mod.__dict__)
-        return mod
+class TemplateImporter(BaseImporter):
+    def create_module(self, spec):
+        return TemplateModule(spec.name)
 
 
-class JsonImporter(BaseImporter):
-    def get_source(self, filename):
-        return """
-import json
-root = json.loads(\"\"\"%s\"\"\")
-locals().update(root)
-""" % slurp(filename)
+class DataImporter(BaseImporter):
+    """data files are parsed once and cached in `__pycache__`,
+    keyed by path, mtime and size, the module's attributes are
+    loaded on first access"""
 
+    def exec_module(self, mod):
+        filename = mod.__file__
 
-class YamlImporter(BaseImporter):
-    def get_source(self, filename):
-        return """
-import yaml
-root = yaml.load(\"\"\"%s\"\"\")
-locals().update(root)
-""" % slurp(filename)
+        def load():
+            root = load_data(filename, self.parse)
+            mod.__dict__.update(root)
+            mod.__dict__['root'] = root
+            mod.__dict__.pop('__getattr__', None)
+            mod.__dict__.pop('__dir__', None)
+            return root
+
+        def __getattr__(name):
+            if name == '__all__':
+                # `from module import *` takes the data keys
+                return [key for key in load() if not key.startswith('_')
+                        ] + ['root']
+            if name.startswith('__'):
+                raise AttributeError(name)
+            load()
+            if name not in mod.__dict__:
+                raise AttributeError("module %s has no attribute %s"
+                                     % (mod.__name__, name))
+            return mod.__dict__[name]
+
+        def __dir__():
+            load()
+            return sorted(mod.__dict__)
+
+        mod.__getattr__ = __getattr__
+        mod.__dir__ = __dir__
+
+
+class JsonImporter(DataImporter):
+    def parse(self, fp):
+        import json
+        return json.load(fp)
+
+
+class YamlImporter(DataImporter):
+    def parse(self, fp):
+        import yaml
+        return yaml.safe_load(fp)
 
 
 class SimpleTemplateImporter(TemplateImporter):
+    """compiles `string.Template` syntax into a python function,
+    only the values used by the template get escaped"""
+
     code_template = """
-from html import escape
-from string import Template
+from klar.importers import escape, chunked
 
-template = Template(\"\"\"%s\"\"\")
+template = %(template)r
 
 def __call__(kvs=None):
     if type(kvs) is dict:
-        return template.substitute({k: escape(v) for k, v in kvs.items()})
+        return ''.join([%(parts)s])
     else:
-        return template.template"""
+        return template
+
+def generate(kvs):
+%(yields)s
+
+def stream(kvs=None, chunk_size=8192):
+    if type(kvs) is dict:
+        return chunked(generate(kvs), chunk_size)
+    else:
+        return chunked([template], chunk_size)"""
 
     def get_source(self, filename):
-        return self.code_template % slurp(filename)
+        template = slurp(filename)
+        parts = ['escape(kvs[%r])' % part if is_name else repr(part)
+                 for is_name, part in compile_template(template)]
+        yields = '\n'.join('    yield %s' % part for part in parts)
+        return self.code_template % dict(template=template,
+                                         parts=', '.join(parts),
+                                         yields=yields or '    yield ""')
 
 
 class JadeImporter(TemplateImporter):
@@ -86,22 +156,45 @@ class JadeImporter(TemplateImporter):
 
 
 class JinjaImporter(TemplateImporter):
+    """depends on jinja2, compiled templates are cached
+    in `__pycache__` next to the template"""
+
+    code_template = """
+from klar.importers import jinja_environment, chunked
+
+template = jinja_environment(%(dirname)r).get_template(%(name)r)
+
+def __call__(kvs=None):
+    return template.render(kvs or {})
+
+def stream(kvs=None, chunk_size=8192):
+    return chunked(template.generate(kvs or {}), chunk_size)"""
+
     def get_source(self, filename):
-        pass
+        return self.code_template % dict(dirname=os.path.dirname(filename),
+                                         name=os.path.basename(filename))
 
 
 class MustacheImporter(TemplateImporter):
     code_template = """
-from pystache import render
+from pystache import parse, Renderer
+from klar.importers import chunked
+
+template = %(template)r
+parsed = parse(template)
+renderer = Renderer()
+
 def __call__(kvs=None):
-    template = \"\"\"%s\"\"\"
     if type(kvs) is dict:
-        return render(template, kvs)
+        return renderer.render(parsed, kvs)
     else:
-        return template"""
+        return template
+
+def stream(kvs=None, chunk_size=8192):
+    return chunked([__call__(kvs)], chunk_size)"""
 
     def get_source(self, filename):
-        return self.code_template % slurp(filename)
+        return self.code_template % dict(template=slurp(filename))
 
 
 class ConfigImporter(BaseImporter):
@@ -109,10 +202,108 @@ class ConfigImporter(BaseImporter):
         return """
 from configparser import ConfigParser
 config = ConfigParser()
-config.read('%(filename)s')
+config.read(%(filename)r)
 """ % dict(filename=filename)
 
 
+def load_data(filename, parse):
+    "parse a data file, reusing the cached result if it's up to date"
+    import pickle
+    stat = os.stat(filename)
+    key = os.path.abspath(filename), stat.st_mtime_ns, stat.st_size
+    cache = os.path.join(os.path.dirname(filename), '__pycache__',
+                         os.path.basename(filename) + '.pickle')
+    try:
+        with open(cache, 'rb') as fp:
+            cached_key, data = pickle.load(fp)
+        if cached_key == key:
+            return data
+    except Exception:
+        pass
+
+    with open(filename) as fp:
+        data = parse(fp)
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp = '%s.%d.tmp' % (cache, os.getpid())
+        with open(tmp, 'wb') as fp:
+            pickle.dump((key, data), fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache)
+    except OSError:
+        pass
+    return data
+
+
+def compile_template(template):
+    "split a `string.Template` into (is_name, text) parts"
+    parts, pos = [], 0
+    for match in Template.pattern.finditer(template):
+        if match.group('invalid') is not None:
+            raise ValueError('Invalid placeholder in %r at %s'
+                             % (template[:20], match.start()))
+        parts.append((False, template[pos:match.start()]))
+        name = match.group('named') or match.group('braced')
+        if name is None:
+            parts.append((False, match.group('escaped')))
+        else:
+            parts.append((True, name))
+        pos = match.end()
+    parts.append((False, template[pos:]))
+    return [(is_name, part) for is_name, part in parts if is_name or part]
+
+
+def chunked(pieces, chunk_size=8192):
+    """join rendered pieces into chunks of at least chunk_size,
+    the chunk ending with </head> is flushed right away"""
+    buf, size, head = [], 0, True
+    for piece in pieces:
+        if head and '</head>' in piece:
+            end = piece.index('</head>') + len('</head>')
+            buf.append(piece[:end])
+            yield ''.join(buf)
+            buf, size, head = [], 0, False
+            piece = piece[end:]
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf, size = [], 0
+    if size:
+        yield ''.join(buf)
+
+
+def escape(value):
+    "escape a value for html according to its type"
+    import html
+    if type(value) is str:
+        return html.escape(value)
+    if value is None:
+        return ''
+    if type(value) in (int, float, bool):
+        return str(value)
+    return html.escape(str(value))
+
+
+_jinja_environments = {}
+
+
+def jinja_environment(dirname):
+    if dirname not in _jinja_environments:
+        from jinja2 import Environment, FileSystemLoader
+        from jinja2 import FileSystemBytecodeCache
+        cache_dir = os.path.join(dirname, '__pycache__')
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        except OSError:
+            bytecode_cache = FileSystemBytecodeCache()
+        _jinja_environments[dirname] = Environment(
+            loader=FileSystemLoader(dirname), autoescape=True,
+            keep_trailing_newline=True,
+            bytecode_cache=bytecode_cache)
+    return _jinja_environments[dirname]
+
+
 def slurp(filename):
     with open(filename) as fp:
         return fp.read()
@@ -123,8 +314,12 @@ def basename(filename):
 
 
 def install(importer):
-    return sys.meta_path.append(importer)
+    finder.importers[importer.ext] = importer
+    if finder not in sys.meta_path:
+        sys.meta_path.append(finder)
 
 
 def uninstall(importer):
-    sys.meta_path.remove(importer)
+    finder.importers.pop(importer.ext, None)
+    if not finder.importers and finder in sys.meta_path:
+        sys.meta_path.remove(finder)
@@ -1,35 +1,39 @@
 import os
 import re
-import zlib
 import json
+import time
 import types
-import random
 import inspect
-import logging
-import mimetypes
+import threading
+from queue import Queue, Full, Empty
 from functools import partial, update_wrapper, wraps
-from collections import Iterable
+from collections.abc import Iterable
 from urllib import parse
-import http.client
-from http.cookies import SimpleCookie
-from cgi import FieldStorage, parse_header
+from http import HTTPStatus
 from datetime import datetime
 
-from jsonschema import validate
-from jsonschema.exceptions import ValidationError, SchemaError
+import biro
 
-from biro import Router
+# jsonschema, cgi, mimetypes, zlib, random, hashlib and logging
+# are imported on first use, see tests/test_misc.py for the budget
 
 
 class App:
 
-    def __init__(self, name='klar_app'):
+    def __init__(self, name='klar_app', snapshot=None):
         self.name = name
+        self.frozen = False
+        self.plans = {}
+        self.batch_paths = set()
+        self.sparse = False
+        self.middleware = self.wsgi
         self.provider = Provider(
             cache=Cache,
             router=Router,
             rest=RestfulRouter,
             emitter=EventEmitter,
+            memoizer=Memoizer,
+            workers=WorkerPool,
         )
         self.provide('req', Request, on_request=True)
         self.provide('res', Response, on_request=True)
@@ -50,6 +54,7 @@ class App:
 
         @self.provide('logger')
         def logger():
+            import logging
             l = logging.getLogger(name)
             l.setLevel(logging.DEBUG)
             return l
@@ -61,6 +66,7 @@ class App:
             return JSONEncoder
 
         def route(method, pattern, handler=None):
+            self.check_frozen()
             if handler is None:
                 return partial(self.provider.router.append, method, pattern)
             return self.provider.router.append(method, pattern, handler)
@@ -79,8 +85,20 @@ class App:
             """ % dict(method=method)
             setattr(self, method, m)
 
-        self.resource = self.provider.rest.resource
-        self.resources = self.provider.rest.resources
+        self.snapshot = snapshot
+        if snapshot and os.path.isfile(snapshot):
+            with open(snapshot) as fp:
+                self.provider.rest.snapshot = json.load(fp)['resources']
+
+    def resource(self, url_path=None, module=None):
+        "register a restful resource, see `RestfulRouter.resource`"
+        self.check_frozen()
+        return self.provider.rest.resource(url_path, module)
+
+    def resources(self, *resources, prefix=''):
+        "register a list of restful resources"
+        self.check_frozen()
+        return self.provider.rest.resources(*resources, prefix=prefix)
 
     def route(self, pattern, methods, handler=None):
         """register multiple routing rules
@@ -92,6 +110,7 @@ class App:
                  pass
 
         """
+        self.check_frozen()
         if handler is None:
             return partial(self.route, pattern, methods)
         for method in methods:
@@ -99,10 +118,153 @@ class App:
         return handler
 
     def __call__(self, environ, start_response):
-        return self.wsgi(environ, start_response)
+        return self.middleware(environ, start_response)
+
+    def use(self, middleware):
+        """wrap the wsgi app, `middleware(app)` returns a wsgi app,
+        the matched route is available as `environ['klar.route']`"""
+        self.check_frozen()
+        self.middleware = middleware(self.middleware)
+
+    def metrics(self, path='/metrics', **options):
+        """collect request metrics, served at `path` in prometheus text
+        format, with `directory` metrics of all processes writing to the
+        same directory are aggregated
+
+        Example:
+
+            app.metrics('/metrics', directory='/tmp/klar-metrics')
+        """
+        from .metrics import Metrics
+        collector = Metrics(**options)
+        self.use(collector.middleware)
+        self.provider.hook(collector.construct)
+
+        def metrics(provider):
+            return collector.render(provider), (
+                'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.get(path, metrics)
+        return collector
+
+    def profile(self, directory, **options):
+        """profile single requests into `directory`, requests are picked
+        by a header signed with `secret`, a sampling `rate` or `routes`,
+        nothing is wrapped unless profiling is enabled
+
+        Example:
+
+            profiler = app.profile('/tmp/profiles', secret='s3cret',
+                                   routes=['/slow/<id>'], mode='sample')
+            # X-Klar-Profile: profiler.sign('GET', '/slow/1')
+        """
+        from .profiler import Profiler
+        self.check_frozen()
+        profiler = Profiler(directory, **options)
+        self.process_request = profiler.wrap(self.process_request,
+                                             self.provider)
+        return profiler
+
+    def track_memory(self, path='/_memory', **options):
+        """track allocations of handlers, response serialization and
+        component construction with tracemalloc, top allocation sites
+        by route and routes retaining memory are served at `path`
+
+        Example:
+
+            app.track_memory('/_memory', rate=0.01, top=20)
+        """
+        from .memory import MemoryTracker
+        self.check_frozen()
+        tracker = MemoryTracker(**options)
+        self.use(tracker.middleware)
+        self.provider.hook(tracker.construct)
+        self.process_request = tracker.wrap(self.process_request,
+                                            self.provider)
+
+        if path:
+            @self.get(path)
+            def memory(provider):
+                return tracker.report(provider)
+        return tracker
+
+    def trace(self, sink=None, **options):
+        """trace sampled requests, spans of component construction,
+        validation, the handler, processors, serialization and session
+        flush are recorded, handlers add spans through `tracer`
+
+        Example:
+
+            from klar.tracing import JsonlSink
+            app.trace(JsonlSink('/tmp/spans.jsonl'), rate=0.01)
+
+            @app.get('/product/<id>')
+            def show(id: int, tracer, db):
+                with tracer.span('db.query', table='products'):
+                    return db.products.find_one(id)
+        """
+        from .tracing import Tracer
+        self.check_frozen()
+        tracer = Tracer(sink, **options)
+        self.use(tracer.middleware)
+        self.provider.hook(tracer.construct)
+        self.prepare_params = tracer.wrap('validate', self.prepare_params)
+        self.handle = tracer.wrap('handler', self.handle)
+
+        @self.provide('tracer')
+        def get_tracer():
+            return tracer
+        return tracer
+
+    def record(self, filename, **options):
+        """append sampled requests to `filename` for `klar replay` and
+        `klar bench --replay`, secrets are redacted
+
+        Example:
+
+            app.record('/var/log/klar/traffic.jsonl', rate=0.05)
+        """
+        from .replay import Recorder
+        recorder = Recorder(filename, **options)
+        self.use(recorder.middleware)
+        return recorder
+
+    def access_log(self, target=None, errors=True, **options):
+        """write a json lines access log to `target`, a filename or a
+        stream, from a background thread, with `errors` warnings and
+        errors of `logger` go to the same log instead of its handlers
+
+        Example:
+
+            log = app.access_log('/var/log/klar/access.jsonl',
+                                 routes={'/health': 0.01})
+            log.stats()  # depth, written, dropped
+        """
+        from .accesslog import AccessLog
+        log = AccessLog(target, **options)
+        self.use(log.middleware)
+        if errors:
+            logger = self.provider.logger
+            logger.addHandler(log.handler())
+            logger.propagate = False
+        return log
+
+    def admission(self, **options):
+        """limit requests in flight, globally and per route, with a
+        bounded priority queue, rejected requests get 503 and Retry-After,
+        enable it after other middleware so it runs first
+
+        Example:
+
+            app.admission(limit=32, routes={'/report/<id>': 2},
+                          max_queue=64, timeout=0.5, target_ms=200)
+        """
+        from .admission import Admission
+        admission = Admission(router=self.provider.router, **options)
+        self.use(admission.middleware)
+        return admission
 
     def wsgi(self, environ, start_response):
-        self.provider.environ = environ
+        self.provider.begin(environ=environ)
         res = self.provider.res
         try:
             self.process_request()
@@ -117,7 +279,7 @@ class App:
             body, status, headers = res.output()
         except:
             self.provider.logger.error('Uncaught exception', exc_info=True)
-            body, status, headers = '', '500 Internal Server Error', []
+            body, status, headers = b'', '500 Internal Server Error', []
 
         if res.code != 500:
             if self.provider.accessed('session'):
@@ -127,20 +289,43 @@ class App:
                 if cookies:
                     headers.extend(cookies)
 
-        self.provider.reset_none_persist()
+        deferred = res.deferred
+        # pooled instances may still be used by a stream or deferred
+        # tasks, they are returned once the server closes the response
+        leases = self.provider.leases()
+        self.provider.reset_none_persist(release=False)
 
         start_response(status, headers)
-        return [body]
+        chunks = body if isinstance(body, Stream) else [body]
+        if deferred is None and not leases:
+            return chunks
+
+        def close():
+            try:
+                if deferred is not None:
+                    deferred.run()
+            finally:
+                self.provider.release(leases)
+        return ClosingIterator(chunks, close)
 
     def process_request(self):
         res = self.provider.res
-        handler, params = self.provider.router.match(
-            self.provider.req.method, self.provider.req.path)
+        router = self.provider.router
+        handler, params = router.match(self.provider.req.method,
+                                       self.provider.req.path)
         if not handler:
             res.code = 404
             return
-
-        params = dict(self.provider.req.query, **params)
+        self.provider.environ['klar.route'] = router.patterns.get(handler)
+
+        query = self.provider.req.query
+        params = dict(query, **params)
+        if self.sparse and 'fields' in query:
+            # parsed up front, a malformed selection is a 400
+            res.fields = self.provider.fields
+            schema = self.plan_for(handler).schema
+            if schema is not None:
+                res.fields.check(schema)
         try:
             prepared_params = self.prepare_params(handler, params)
         except ValidationError as e:
@@ -153,30 +338,122 @@ class App:
             res.body = "Error in schema: %s" % e.message
             return
 
-        res.from_handler(handler(**prepared_params))
+        res.from_handler(self.handle(handler, prepared_params))
 
-        processers = handler.__annotations__.get('return')
-        if processers is not None:
-            if type(processers) is tuple:
-                self.provider.res.pipe(*processers)
-            else:
-                self.provider.res.pipe(processers)
+        processers = self.plan_for(handler).processers
+        if processers:
+            self.provider.res.pipe(*processers)
+
+    def handle(self, handler, params):
+        "call the matched handler with prepared params"
+        return handler(**params)
+
+    def dispatch(self, method, path, body=None, headers=None, environ=None):
+        """handle a request without going through the server, headers
+        of `environ` are passed on, returns code, headers and body
+
+        middleware registered with `use` is bypassed, metrics, access
+        log, tracing and admission see only the outer request
+        """
+        from io import BytesIO
+        path, _, query = path.partition('?')
+        content = b'' if body is None else json.dumps(
+            body, cls=self.provider.json_encoder).encode()
+        env = {key: value for key, value in (environ or {}).items()
+               if key.startswith('HTTP_') or key.startswith('SERVER_')}
+        env.update({
+            'REQUEST_METHOD': method.upper(),
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(content)),
+            'wsgi.input': BytesIO(content),
+        })
+        for key, value in (headers or {}).items():
+            env['HTTP_' + key.replace('-', '_').upper()] = value
+
+        response = {}
+
+        def start_response(status, headers):
+            response['code'] = int(status.split(' ')[0])
+            response['headers'] = dict(headers)
+
+        chunks = self.wsgi(env, start_response)
+        try:
+            content = b''.join(chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        return response['code'], response['headers'], content
+
+    def batch(self, prefix='', parallel=False, max_size=100):
+        """register `POST <prefix>/_batch`, which takes a list of
+        `{method, path, body, headers}` and returns a list of
+        `{status, headers, body}`, sub-requests are dispatched internally
+        with `dispatch` and bypass middleware
+
+        Example:
+
+            app.resources(product, catalog, prefix='/v1')
+            app.batch('/v1', parallel=True)
+        """
+        path = prefix + '/_batch'
+        self.batch_paths.add(path)
+        executor = []
+
+        def dispatch(request, environ):
+            if not isinstance(request, dict) or 'path' not in request:
+                return {'status': 400, 'headers': {},
+                        'body': 'path is required'}
+            if request['path'].partition('?')[0] in self.batch_paths:
+                return {'status': 400, 'headers': {},
+                        'body': "batches can't be nested"}
+            code, headers, content = self.dispatch(
+                request.get('method', 'GET'), request['path'],
+                request.get('body'), request.get('headers'), environ)
+            content = content.decode()
+            if headers.get('Content-Type', '').startswith('application/json'):
+                content = json.loads(content)
+            return {'status': code, 'headers': headers, 'body': content}
+
+        def handle_batch(body, req):
+            if not isinstance(body, list):
+                raise HttpError(400, "a list of requests is expected")
+            if len(body) > max_size:
+                raise HttpError(400, "at most %s requests in a batch"
+                                % max_size)
+            environ = req.environ
+            if not parallel:
+                return [dispatch(request, environ) for request in body]
+            if not executor:
+                from concurrent.futures import ThreadPoolExecutor
+                executor.append(ThreadPoolExecutor(thread_name_prefix='batch'))
+            return list(executor[0].map(partial(dispatch, environ=environ),
+                                        body))
+
+        self.post(path, handle_batch)
+        return handle_batch
+
+    def plan_for(self, handler):
+        if handler not in self.plans:
+            self.plans[handler] = Plan(handler)
+        return self.plans[handler]
 
     def prepare_params(self, handler, params):
-        args = inspect.getargs(handler.__code__)[0]
-        params = dict(get_arg_defaults(handler), **params)
-        for name in args:
+        plan = self.plan_for(handler)
+        params = dict(plan.defaults, **params)
+        for name in plan.args:
             if hasattr(self.provider, name):
                 params[name] = getattr(self.provider, name)
 
             if name not in params:
-                if name in handler.__annotations__:
+                if name in plan.annotations:
                     raise HttpError(400, "%s is required" % name)
                 else:
                     raise HttpError(500, "can't provide %s" % name)
 
-            if name in handler.__annotations__:
-                anno = handler.__annotations__[name]
+            if name in plan.annotations:
+                anno = plan.annotations[name]
                 if type(anno) is dict:
                     validate(params[name], anno)
                 elif callable(anno):
@@ -184,29 +461,218 @@ class App:
                 else:
                     raise HttpError(500, "unrecognized annotation type for %s"
                                     % name)
-        return {name: params[name] for name in args}
+        return {name: params[name] for name in plan.args}
+
+    def freeze(self, snapshot=None):
+        """stop accepting registrations and prepare everything needed
+        for dispatching, resource scans are written to `snapshot` so
+        other processes can skip them
+
+        Example:
+
+            app = App(snapshot='app.snapshot')
+            app.resources(article, user)
+            app.freeze()
+        """
+        self.provider.check()
+        for rules in self.provider.router.__idx__.values():
+            for method, pattern, handler in rules:
+                for anno in self.plan_for(handler).annotations.values():
+                    if type(anno) is dict:
+                        get_validator(anno)
+        self.frozen = True
+        snapshot = snapshot or self.snapshot
+        if snapshot:
+            tmp = '%s.%d.tmp' % (snapshot, os.getpid())
+            with open(tmp, 'w') as fp:
+                json.dump({'resources': self.provider.rest.rules}, fp)
+            os.replace(tmp, snapshot)
+        return self
+
+    def warmup(self, workers=4):
+        """build persistent components before serving, independent ones
+        are built concurrently, returns the seconds each one took
+
+        Example:
+
+            app.warmup()
+            {'config': 0.0012, 'db': 0.2034, 'cache': 0.0521}
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait
+        from concurrent.futures import FIRST_COMPLETED
+        graph = self.provider.check()
+        skip = set(self.provider.__once__) | set(self.provider.__pools__)
+        skip.add('environ')
+        pending = {name for name in graph
+                   if not self.provider.accessed(name) and
+                   not self.depends_on(graph, name, skip)}
+        timings, running = {}, {}
+        with ThreadPoolExecutor(workers) as pool:
+            while pending or running:
+                for name in sorted(pending):
+                    if not any(dep in pending or dep in running.values()
+                               for dep in graph[name]):
+                        pending.remove(name)
+                        running[pool.submit(self.provider.build, name)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    timings[running.pop(future)] = future.result()
+        return timings
+
+    def depends_on(self, graph, name, names):
+        "whether a component depends on any of names, directly or not"
+        deps = list(graph.get(name, ()))
+        seen = set()
+        while deps:
+            dep = deps.pop()
+            if dep in names:
+                return True
+            if dep not in seen:
+                seen.add(dep)
+                deps.extend(graph.get(dep, ()))
+        return name in names
+
+    def check_frozen(self):
+        if self.frozen:
+            raise RuntimeError("%r is frozen, can't register more" % self)
+
+    def provide(self, name, component=None, on_request=False, pool=None):
+        """register a component, persistent by default, or built for
+        every request with `on_request=True`, or leased from a pool
+        for every request with `pool` options
+
+        Example:
 
-    def provide(self, name, component=None, on_request=False):
+            @provide('db', pool={'size': 10, 'timeout': 1})
+            def db(config):
+                return connect(config['db'])
+        """
+        self.check_frozen()
         if component is None:
             def decorate(fn):
-                self.provider.register(name, fn, persist=not on_request)
+                self.provider.register(name, fn, persist=not on_request,
+                                       pool=pool)
                 return fn
             return decorate
         else:
-            self.provider.register(name, component, persist=not on_request)
+            self.provider.register(name, component, persist=not on_request,
+                                   pool=pool)
+
+    def memoize(self, fn=None, ttl=None, key=None, tags=()):
+        """cache results of a handler, provider or function in `cache`
+
+        Example:
+
+            @app.get('/product/<product_id>')
+            @app.memoize(ttl=60, tags=['product:{product_id}'])
+            def show(product_id, db):
+                return db.products.find_one(product_id)
+
+            show.invalidate(product_id='42')
+            memoizer.invalidate_tag('product:42')
+        """
+        if fn is None:
+            return partial(self.memoize, ttl=ttl, key=key, tags=tags)
+        return self.provider.memoizer.memoize(fn, ttl=ttl, key=key, tags=tags)
 
-    def on(self, event, handler=None):
+    def batched(self, fn=None, max_size=64, max_wait_ms=2):
+        """collect concurrent calls into one call, persistent components
+        are taken from the first call, request scoped and pooled ones and
+        other arguments are passed as lists, the function returns a list
+        of results in the same order, calls need to come from different
+        threads
+
+        Example:
+
+            @app.get('/product/<product_id>')
+            @app.batched(max_size=100, max_wait_ms=5)
+            def show(product_id, db):
+                products = db.products.find({'_id': {'$in': product_id}})
+                found = {p['_id']: p for p in products}
+                return [found.get(id, 404) for id in product_id]
+        """
+        if fn is None:
+            return partial(self.batched, max_size=max_size,
+                           max_wait_ms=max_wait_ms)
+        batcher = Batcher(fn, self.provider, max_size, max_wait_ms)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            return batcher(*args, **kwargs)
+        return wrapper
+
+    def loader(self, name, batch_fn=None):
+        """register a batching loader as a component, keys requested
+        during a request are fetched by one batch_fn call and cached
+        until the request ends
+
+        Example:
+
+            @app.loader('users')
+            def load_users(keys, db):
+                return db.users.find({'_id': {'$in': keys}})
+
+            @app.get('/article/<article_id>')
+            def show(article_id, db, users):
+                article = db.articles.find_one(article_id)
+                article['author'] = users.load(article['author_id']).get()
+        """
+        if batch_fn is None:
+            return partial(self.loader, name)
+        self.provide(name, lambda provider: Loader(batch_fn, provider),
+                     on_request=True)
+        return batch_fn
+
+    def sparse_fields(self):
+        """select fields of json responses with `?fields=`, handlers get
+        the selection as the `fields` component, which then takes the
+        place of a `fields` query parameter
+
+        Example:
+
+            app.sparse_fields()
+
+            @app.get('/article/<article_id>')
+            def show(article_id, fields, db):
+                return db.articles.find_one(article_id, fields.paths())
+        """
+        self.check_frozen()
+        self.provide('fields', Fields, on_request=True)
+        self.sparse = True
+
+    def on(self, event, handler=None, background=False):
+        """register an event listener, listeners with `background=True`
+        are run by `workers` after their arguments are resolved
+
+        Example:
+
+            @on('user-login', background=True)
+            def onlogin(userid, db):
+                pass
+        """
+        self.check_frozen()
         if handler:
-            return self.provider.emitter.register(event, handler)
+            return self.provider.emitter.register(event, handler, background)
         else:
-            return partial(self.provider.emitter.register, event)
+            return partial(self.on, event, background=background)
 
-    def run(self, port=3000):
-        from wsgiref.simple_server import make_server
+    def run(self, port=3000, threaded=False):
         self.provider.logger.info('listen on %s' % port)
-        make_server('', port, self).serve_forever()
+        self.server(port=port, threaded=threaded).serve_forever()
+
+    def server(self, host='', port=3000, threaded=False):
+        "a wsgiref server for the app, `port` 0 picks a free port"
+        from wsgiref.simple_server import make_server, WSGIServer
+        server_class = WSGIServer
+        if threaded:
+            from socketserver import ThreadingMixIn
+            server_class = type('ThreadingWSGIServer',
+                                (ThreadingMixIn, WSGIServer),
+                                {'daemon_threads': True})
+        return make_server(host, port, self, server_class)
 
     def static(self, url_root, fs_root=None):
+        self.check_frozen()
         if not url_root.endswith('/'):
             url_root = url_root + '/'
         if fs_root is None:
@@ -234,40 +700,258 @@ class App:
         print(repr(self.provider.router))
 
 
+class Plan:
+    "what's needed to call a handler, computed once per handler"
+
+    def __init__(self, handler):
+        self.args = get_args(handler)
+        self.defaults = get_arg_defaults(handler)
+        self.annotations = dict(getattr(handler, '__annotations__', {}))
+        processers = self.annotations.pop('return', None)
+        if processers is None:
+            processers = ()
+        elif type(processers) is not tuple:
+            processers = (processers,)
+        schemas = [p for p in processers if type(p) is dict]
+        self.schema = schemas[0] if schemas else None
+        self.processers = tuple(p for p in processers if type(p) is not dict)
+
+
 class Provider:
 
     def __init__(self, protos=None, **kwargs):
         self.protos = protos or kwargs
         self.__once__ = []
+        self.__pools__ = {}
+        self.__hooks__ = []
+        self.__local__ = RequestScope()
 
     def __getattr__(self, name):
+        scope = self.__local__.values
+        if name in scope:
+            return scope[name]
         if name not in self.protos:
             raise AttributeError("%s not registered" % name)
-        elif type(self.protos[name]) is tuple:
-            cls, params = self.protos[name]
-            self.__dict__[name] = instance(cls, params, self)
-        elif isinstance(self.protos[name], type):
-            self.__dict__[name] = instance(self.protos[name], self)
+        if name in self.__pools__:
+            scope[name] = self.__pools__[name].lease()
+        elif name in self.__once__:
+            scope[name] = self.construct(name)
         else:
-            self.__dict__[name] = invoke(self.protos[name], self)
-        return self.__dict__[name]
+            self.__dict__[name] = self.construct(name)
+            return self.__dict__[name]
+        return scope[name]
 
     def __delattr__(self, name):
         if name in self.__dict__:
             del self.__dict__[name]
+        self.__local__.values.pop(name, None)
+
+    def hook(self, hook):
+        """wrap construction of components, called as
+        `hook(name, build)`, build() returns the new instance"""
+        self.__hooks__.append(hook)
+
+    def construct(self, name):
+        "build a new instance of a component"
+        if self.__hooks__:
+            build = partial(self.create, name)
+            for hook in self.__hooks__:
+                build = partial(hook, name, build)
+            return build()
+        return self.create(name)
+
+    def create(self, name):
+        if type(self.protos[name]) is tuple:
+            cls, params = self.protos[name]
+            return instance(cls, params, self)
+        elif isinstance(self.protos[name], type):
+            return instance(self.protos[name], self)
+        else:
+            return invoke(self.protos[name], self)
 
-    def register(self, name, value, persist=True):
+    def register(self, name, value, persist=True, pool=None):
         self.protos[name] = value
-        if not persist:
+        if pool is not None:
+            self.__pools__[name] = Pool(partial(self.construct, name),
+                                        name=name, **pool)
+        elif not persist:
             self.__once__.append(name)
 
+    def begin(self, **values):
+        "start a request scope in current thread, scopes can be nested"
+        self.__local__.parents.append(self.__local__.values)
+        self.__local__.values = values
+
     def accessed(self, name):
-        return name in self.__dict__
+        return name in self.__dict__ or name in self.__local__.values
+
+    def persistent(self, name):
+        "whether one instance of a component is shared by every request"
+        return name in self.protos and name not in self.__pools__ and \
+            name not in self.__once__
+
+    def pooled(self, name):
+        return name in self.__pools__
+
+    def leases(self):
+        "(pool, instance) leased by the request scope of current thread"
+        scope = self.__local__.values
+        return [(pool, scope[name]) for name, pool in self.__pools__.items()
+                if name in scope]
+
+    def release(self, leases):
+        for pool, instance in leases:
+            pool.release(instance)
+
+    def reset_none_persist(self, release=True):
+        """end the request scope in current thread, leases are returned
+        unless `release` is False, then they are up to the caller"""
+        if release:
+            self.release(self.leases())
+        parents = self.__local__.parents
+        self.__local__.values = parents.pop() if parents else {}
+
+    def dependencies(self, name):
+        "names a component is built from, optional ones only if registered"
+        proto, params = self.protos[name], {}
+        if type(proto) is tuple:
+            proto, params = proto
+        if isinstance(proto, type) and \
+                not isinstance(proto.__init__, types.FunctionType):
+            return []
+        defaults = get_arg_defaults(proto)
+        return [arg for arg in get_args(proto) if arg not in params and
+                (arg in self.protos or arg not in defaults)]
+
+    def graph(self):
+        return {name: self.dependencies(name) for name in self.protos}
+
+    def check(self, externals=('environ',)):
+        """make sure every dependency is registered and there are
+        no cycles, raise DependencyError otherwise"""
+        graph = self.graph()
+        for name, deps in graph.items():
+            for dep in deps:
+                if dep not in graph and dep not in externals and \
+                        dep not in self.__dict__:
+                    raise DependencyError("%s depends on %s, which is not "
+                                          "registered" % (name, dep))
+        done, path = set(), []
+
+        def visit(name):
+            if name in path:
+                cycle = path[path.index(name):] + [name]
+                raise DependencyError("cyclic dependency %s"
+                                      % ' -> '.join(cycle))
+            if name in done or name not in graph:
+                return
+            path.append(name)
+            for dep in graph[name]:
+                visit(dep)
+            path.pop()
+            done.add(name)
+
+        for name in graph:
+            visit(name)
+        return graph
+
+    def build(self, name):
+        "build a component, returns seconds it took"
+        start = time.perf_counter()
+        getattr(self, name)
+        return time.perf_counter() - start
+
+
+class RequestScope(threading.local):
+    "request scoped components of current thread"
+
+    def __init__(self):
+        self.values = {}
+        self.parents = []
+
+
+class Pool:
+    """a bounded pool of component instances, leased to a request on
+    first access and returned when the request ends
+
+    an instance is discarded when `check(instance)` returns false or
+    it has been idle for more than `max_idle` seconds, a request waits
+    at most `timeout` seconds for an instance, then gets a 503
+    """
+
+    def __init__(self, create, name='pool', size=10, timeout=5,
+                 max_idle=None, check=None, dispose=None):
+        self.create = create
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check = check
+        self.dispose = dispose
+        self.idle = []
+        self.created = 0
+        self.exhausted = 0
+        self.cond = threading.Condition()
+
+    def lease(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self.cond:
+                while not self.idle and self.created >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.exhausted += 1
+                        raise HttpError(503, "%s pool exhausted" % self.name)
+                    self.cond.wait(remaining)
+                if not self.idle:
+                    self.created += 1
+                    break
+                item, since = self.idle.pop()
+            if self.usable(item, since):
+                return item
+            self.discard(item)
+        try:
+            return self.create()
+        except Exception:
+            self.discard(None)
+            raise
+
+    def usable(self, item, since):
+        if self.max_idle is not None and \
+                time.monotonic() - since > self.max_idle:
+            return False
+        try:
+            return self.check is None or self.check(item)
+        except Exception:
+            return False
+
+    def release(self, item):
+        with self.cond:
+            self.idle.append((item, time.monotonic()))
+            self.cond.notify()
+
+    def discard(self, item):
+        with self.cond:
+            self.created -= 1
+            self.cond.notify()
+        if item is None:
+            return
+        try:
+            if self.dispose is not None:
+                self.dispose(item)
+            elif hasattr(item, 'close'):
+                item.close()
+        except Exception:
+            pass
 
-    def reset_none_persist(self):
-        for name in self.__once__:
-            if name in self.__dict__:
-                del self.__dict__[name]
+    def stats(self):
+        return {
+            'size': self.size,
+            'created': self.created,
+            'idle': len(self.idle),
+            'leased': self.created - len(self.idle),
+            'exhausted': self.exhausted,
+        }
 
 
 class cached_property:
@@ -318,6 +1002,7 @@ class Request:
         elif content_type == 'application/x-www-form-urlencoded':
             self._body = dict(parse.parse_qsl(self.get_raw_body()))
         elif content_type == 'multipart/form-data':
+            from cgi import FieldStorage
             fs = FieldStorage(self.environ['wsgi.input'], environ=self.environ)
             self._body, self._uploads = {}, {}
             for name in fs.keys():
@@ -363,6 +1048,7 @@ class Cookies:
     }
 
     def __init__(self, environ):
+        from http.cookies import SimpleCookie
         self.cookies = SimpleCookie()
         if 'HTTP_COOKIE' in environ:
             self.cookies.load(environ['HTTP_COOKIE'])
@@ -417,6 +1103,7 @@ class Session:
     @property
     def sid(self):
         if not hasattr(self, '_sid'):
+            import random
             self._sid = ''.join(random.choice(self.chars)
                                 for i in range(self.key_len))
             self.cookies.set(self.sid_key, self._sid, httponly=True)
@@ -472,31 +1159,461 @@ class Cache:
         self.__dict__[key] = value
 
     def delete(self, key):
-        del self.__dict__[key]
+        self.__dict__.pop(key, None)
+
+
+class Memoizer:
+
+    key_prefix = 'memo:'
+    tag_prefix = 'memo-tag:'
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def memoize(self, fn, ttl=None, key=None, tags=()):
+        sig = inspect.signature(fn)
+        name = '%s.%s' % (fn.__module__, fn.__qualname__)
+
+        def params_of(args, kwargs):
+            bound = sig.bind_partial(*args, **kwargs)
+            bound.apply_defaults()
+            return bound.arguments
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            params = params_of(args, kwargs)
+            return self.fetch(self.key_for(name, key, params, fn),
+                              partial(fn, *args, **kwargs), ttl,
+                              [tag.format(**params) for tag in tags])
+
+        def invalidate(*args, **kwargs):
+            self.invalidate(self.key_for(name, key, params_of(args, kwargs),
+                                         fn))
+
+        wrapper.invalidate = invalidate
+        return wrapper
+
+    def key_for(self, name, key, params, fn):
+        """arguments provided by components are left out of the key,
+        unless they are annotated(validated) like `body: schema`"""
+        if callable(key):
+            return self.key_prefix + str(invoke(key, params))
+        if key is not None:
+            return self.key_prefix + key.format(**params)
+        annotations = getattr(fn, '__annotations__', {})
+        params = {k: v for k, v in params.items()
+                  if k in annotations or k not in self.provider.protos}
+        import hashlib
+        digest = hashlib.sha1(json.dumps(
+            params, cls=self.provider.json_encoder, sort_keys=True).encode())
+        return '%s%s:%s' % (self.key_prefix, name, digest.hexdigest())
+
+    def fetch(self, key, compute, ttl=None, tags=()):
+        versions = {tag: self.tag_version(tag) for tag in tags}
+        found, value = self.load(key, versions)
+        if found:
+            with self.lock:
+                self.hits += 1
+            return value
+
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return flight.wait()
+
+        try:
+            # the previous flight may have stored it since the miss above
+            found, flight.value = self.load(key, versions)
+            with self.lock:
+                if found:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if not found:
+                flight.value = compute()
+                self.store(key, flight.value, ttl, versions)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+
+    def load(self, key, versions=None):
+        data = self.provider.cache.get(key)
+        if data is None:
+            return False, None
+        if type(data) is not str:
+            data = data.decode()
+        entry = json.loads(data)
+        if entry['expires'] is not None and entry['expires'] < time.time():
+            return False, None
+        if entry['tags'] != (versions or {}):
+            return False, None
+        if 'tuple' in entry:
+            # rebuild `(code, body, (header, value))` returned by handlers
+            return True, tuple(tuple(item) if is_tuple else item
+                               for item, is_tuple in zip(entry['value'],
+                                                         entry['tuple']))
+        return True, entry['value']
+
+    def store(self, key, value, ttl=None, versions=None):
+        expires = None if ttl is None else time.time() + ttl
+        entry = {'value': value, 'expires': expires, 'tags': versions or {}}
+        if type(value) is tuple:
+            entry['tuple'] = [type(item) is tuple for item in value]
+        self.provider.cache.set(key, json.dumps(
+            entry, cls=self.provider.json_encoder))
+
+    def tag_version(self, tag):
+        version = self.provider.cache.get(self.tag_prefix + tag)
+        if version is None:
+            return '0'
+        return version if type(version) is str else version.decode()
+
+    def invalidate(self, key):
+        """drop a cached result, keys are the ones passed as `key`"""
+        if not key.startswith(self.key_prefix):
+            key = self.key_prefix + key
+        self.provider.cache.delete(key)
+
+    def invalidate_tag(self, tag):
+        """drop every cached result tagged with `tag`"""
+        version = int(self.tag_version(tag)) + 1
+        self.provider.cache.set(self.tag_prefix + tag, str(version))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class Flight:
+    "a pending computation other callers can wait for"
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
 
 
 class EventEmitter:
 
     def __init__(self, provider):
         self.listeners = {}
+        self.background = {}
         self.provider = provider
 
     def emit(self, event, **kargs):
         if event in self.listeners:
             for listener in self.listeners[event]:
                 invoke(listener, kargs, self.provider)
+        if event in self.background:
+            for listener in self.background[event]:
+                self.provider.workers.submit(self.task(listener, kargs))
+
+    def task(self, listener, kargs):
+        """`listener` with its arguments resolved now, except pooled
+        components, which are leased by the worker running it"""
+        pooled = [name for name in get_args(listener)
+                  if name not in kargs and self.provider.pooled(name)]
+        params = resolve_args(listener, kargs, dict.fromkeys(pooled),
+                              self.provider)
+        if not pooled:
+            return partial(listener, **params)
+
+        def run():
+            self.provider.begin()
+            try:
+                params.update((name, getattr(self.provider, name))
+                              for name in pooled)
+                listener(**params)
+            finally:
+                self.provider.reset_none_persist()
+        return run
+
+    def register(self, event, handler, background=False):
+        listeners = self.background if background else self.listeners
+        if event in listeners:
+            listeners[event].append(handler)
+        else:
+            listeners[event] = [handler]
+        return handler
 
-    def register(self, event, handler):
-        if event in self.listeners:
-            self.listeners[event].append(handler)
+
+class WorkerPool:
+    """a bounded queue drained by background threads
+
+    backpressure decides what happens when the queue is full:
+    `block` waits for a free slot, `drop` discards the task,
+    `spill` runs the task in the calling thread
+    """
+
+    def __init__(self, logger, size=4, max_queue=1024, batch_size=16,
+                 backpressure='block'):
+        if backpressure not in ('block', 'drop', 'spill'):
+            raise ValueError("unknown backpressure %s" % backpressure)
+        self.logger = logger
+        self.size = size
+        self.batch_size = batch_size
+        self.backpressure = backpressure
+        self.queue = Queue(max_queue)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def submit(self, task):
+        if len(self.threads) < self.size:
+            self.start()
+        if self.backpressure == 'block':
+            self.queue.put(task)
+            return
+        try:
+            self.queue.put_nowait(task)
+        except Full:
+            if self.backpressure == 'drop':
+                with self.lock:
+                    self.dropped += 1
+            else:
+                with self.lock:
+                    self.spilled += 1
+                self.run(task)
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work, daemon=True,
+                                          name='klar-worker-%s'
+                                          % len(self.threads))
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            for task in batch:
+                self.run(task)
+                self.queue.task_done()
+
+    def run(self, task):
+        failed = False
+        try:
+            task()
+        except Exception:
+            failed = True
+            self.logger.error('Error in background task', exc_info=True)
+        with self.lock:
+            self.processed += 1
+            if failed:
+                self.errors += 1
+
+    def join(self):
+        "wait until every queued task is processed"
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': self.queue.qsize(),
+                'processed': self.processed,
+                'errors': self.errors,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+            }
+
+
+class Batcher:
+
+    def __init__(self, fn, provider, max_size=64, max_wait_ms=2):
+        self.fn = fn
+        self.provider = provider
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self.signature = inspect.signature(fn)
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def __call__(self, *args, **kwargs):
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        with self.lock:
+            batch, leader = self.batch, self.batch is None
+            if leader:
+                batch = self.batch = Batch(bound.arguments)
+            index = len(batch.calls)
+            batch.calls.append(bound.arguments)
+            if len(batch.calls) >= self.max_size:
+                self.batch = None
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self.lock:
+                if self.batch is batch:
+                    self.batch = None
+            self.run(batch)
+        return batch.result(index)
+
+    def run(self, batch):
+        annotations = getattr(self.fn, '__annotations__', {})
+        params = {}
+        for name, value in batch.components.items():
+            # request scoped and pooled components differ between calls
+            if self.provider.persistent(name) and name not in annotations:
+                params[name] = value
+            else:
+                params[name] = [call[name] for call in batch.calls]
+        try:
+            batch.results = list(self.fn(**params))
+            if len(batch.results) != len(batch.calls):
+                raise Exception("%s returned %s results for %s calls" % (
+                    self.fn.__name__, len(batch.results), len(batch.calls)))
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+
+class Batch:
+
+    def __init__(self, components):
+        self.components = components
+        self.calls = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+    def result(self, index):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.results[index]
+
+
+class Loader:
+    """collects keys, loads them with a single batch_fn call, batch_fn
+    returns values in the order of keys, or a dict keyed by key"""
+
+    def __init__(self, batch_fn, provider):
+        self.batch_fn = batch_fn
+        self.provider = provider
+        self.cache = {}
+        self.queue = {}
+
+    def load(self, key):
+        "get a pending value, `.get()` or `await` it"
+        if key not in self.cache:
+            self.queue[key] = None
+        return Pending(self, key)
+
+    def load_many(self, keys):
+        for key in keys:
+            self.load(key)
+        self.dispatch()
+        return [self.cache[key] for key in keys]
+
+    def dispatch(self):
+        keys, self.queue = list(self.queue), {}
+        if not keys:
+            return
+        values = invoke(self.batch_fn, {'keys': keys}, self.provider)
+        if isinstance(values, dict):
+            values = [values.get(key) for key in keys]
         else:
-            self.listeners[event] = [handler]
+            values = list(values)
+        if len(values) != len(keys):
+            raise Exception("%s returned %s values for %s keys" % (
+                self.batch_fn.__name__, len(values), len(keys)))
+        self.cache.update(zip(keys, values))
+
+
+class Pending:
+    "a value a Loader will fetch together with other pending ones"
+
+    def __init__(self, loader, key):
+        self.loader = loader
+        self.key = key
+
+    def get(self):
+        if self.key not in self.loader.cache:
+            self.loader.dispatch()
+        return self.loader.cache[self.key]
+
+    def __await__(self):
+        if self.key not in self.loader.cache:
+            import asyncio
+            yield from asyncio.sleep(0).__await__()
+        return self.get()
 
 
 class HttpError(Exception):
     pass
 
 
+class DependencyError(Exception):
+    pass
+
+
+class ValidationError(Exception):
+    "value doesn't match its schema"
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class SchemaError(Exception):
+    "schema itself is invalid"
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class Router(biro.Router):
+    "remembers the pattern each handler is registered with"
+
+    def __init__(self):
+        super().__init__()
+        self.patterns = {}
+
+    def append(self, method, pattern, handler):
+        self.patterns[handler] = pattern if type(pattern) is str \
+            else pattern.pattern
+        return super().append(method, pattern, handler)
+
+
 class RestfulRouter:
 
     restful_routes = [
@@ -512,6 +1629,8 @@ class RestfulRouter:
 
     def __init__(self, router):
         self.router = router
+        self.rules = {}
+        self.snapshot = {}
 
     def resource(self, url_path=None, module=None):
         """register a restful resource
@@ -548,9 +1667,35 @@ class RestfulRouter:
             self.register_resource(url_path, resource)
 
     def register_resource(self, url_path, module):
+        fingerprint = self.fingerprint(module)
+        entry = self.snapshot.get(url_path)
+        if entry and entry.get('fingerprint') == fingerprint:
+            rules = [tuple(rule) for rule in entry['rules']]
+        else:
+            rules = self.scan_resource(url_path, module)
+        self.rules[url_path] = {'fingerprint': fingerprint, 'rules': rules}
+        self.router.extend((method, pattern, getattr(module, name))
+                           for method, pattern, name in rules)
+        return module
+
+    def fingerprint(self, module):
+        """identifies a version of a resource, by size and mtime of the
+        module's file, or by public names of classes and modules without
+        one"""
+        source = getattr(module, '__file__', None)
+        if source and isinstance(module, types.ModuleType):
+            try:
+                stat = os.stat(source)
+                return [stat.st_size, stat.st_mtime_ns]
+            except OSError:
+                pass
+        return [name for name in dir(module) if not name.startswith('_')]
+
+    def scan_resource(self, url_path, module):
+        "get (method, pattern, attribute name) rules of a resource"
         url_id = '%s_id' % url_path.split('/').pop()
         vals = {'path': url_path, 'id': url_id}
-        rules = [(method, pattern % vals, getattr(module, handler))
+        rules = [(method, pattern % vals, handler)
                  for method, pattern, handler in self.restful_routes
                  if hasattr(module, handler)]
 
@@ -561,16 +1706,16 @@ class RestfulRouter:
 
         custom_rules = [(fn.__httpmethod__,
                          '%s/<%s>/%s' % (url_path, url_id, fn.__name__),
-                        fn) for fn in fns]
-        self.router.extend(rules)
-        self.router.extend(custom_rules)
-        return module
+                        fn.__name__) for fn in fns]
+        return rules + custom_rules
 
 
 class Response:
 
     def __init__(self, json_encoder, environ, provider):
         self.body = None
+        self.fields = None
+        self.deferred = None
         self.code = 200
         self.headers = {}
         self.json_encoder = json_encoder
@@ -581,7 +1726,12 @@ class Response:
         headers = {'Content-Type': 'text/html; charset=utf-8'}
         body = '' if self.body is None else self.body
         code = self.code
-        if type(body) not in [str, bytes]:
+        if type(body) is Stream:
+            if body.content_type:
+                headers = {'Content-Type': body.content_type}
+        elif type(body) not in [str, bytes]:
+            if self.fields:
+                body = self.fields.project(body)
             body = json.dumps(body, cls=self.json_encoder)
             headers = {'Content-Type': 'application/json; charset=utf-8'}
         headers.update(self.headers)
@@ -618,6 +1768,249 @@ class Response:
     def header(self, key, value):
         self.headers[key] = value
 
+    def defer(self, fn, **kwargs):
+        "run fn after the response is sent"
+        if self.deferred is None:
+            self.deferred = Deferred(self.provider)
+        return self.deferred(fn, **kwargs)
+
+
+class Page:
+    """keyset pagination for list endpoints, reads `limit` and an
+    opaque `cursor` from the query string
+
+    Example:
+
+        app.provide('page', Page, on_request=True)
+
+        def query(page, db):
+            found = db.products.find({'_id': {'$gt': page.after}}
+                                     if page.after else {})
+            return page.results(found.sort('_id').limit(page.limit + 1),
+                                key='_id')
+    """
+
+    def __init__(self, req, res, json_encoder, default_limit=20,
+                 max_limit=100, chunk_size=8192):
+        self.req = req
+        self.res = res
+        self.json_encoder = json_encoder
+        self.chunk_size = chunk_size
+        try:
+            limit = int(req.query.get('limit', default_limit))
+        except ValueError:
+            raise HttpError(400, "limit should be a number")
+        if limit < 1:
+            raise HttpError(400, "limit should be positive")
+        self.limit = min(limit, max_limit)
+        self.after = None
+        if req.query.get('cursor'):
+            self.after = self.decode(req.query['cursor'])
+
+    def encode(self, value):
+        "turn the key of the last item into a cursor"
+        import base64
+        return base64.urlsafe_b64encode(json.dumps(
+            value, cls=self.json_encoder).encode()).decode().rstrip('=')
+
+    def decode(self, cursor):
+        import base64
+        try:
+            return json.loads(base64.urlsafe_b64decode(
+                cursor + '=' * (-len(cursor) % 4)).decode())
+        except ValueError:
+            raise HttpError(400, "invalid cursor")
+
+    def link(self, cursor):
+        query = dict(self.req.query, cursor=cursor, limit=self.limit)
+        return '<%s?%s>; rel="next"' % (self.req.path, parse.urlencode(query))
+
+    def results(self, items, key):
+        """stream up to `limit` items as `{"items": [...], "next": cursor}`,
+        fetch `limit + 1` items to let it know there's a next page,
+        the Link header is only set when items is a list"""
+        if not callable(key):
+            key = partial(lambda name, item: item[name], key)
+        if isinstance(items, (list, tuple)) and len(items) > self.limit:
+            self.res.headers['Link'] = self.link(self.encode(
+                key(items[self.limit - 1])))
+        return Stream(self.stream(iter(items), key),
+                      'application/json; charset=utf-8')
+
+    def stream(self, items, key):
+        encode = self.json_encoder().encode
+        fields = self.res.fields
+        project = fields.project if fields else lambda item: item
+        buf, size, last, count = ['{"items": ['], 0, None, 0
+        for item in items:
+            if count == self.limit:
+                break
+            chunk = encode(project(item))
+            buf.append(',' + chunk if count else chunk)
+            size += len(chunk)
+            last, count = item, count + 1
+            if size >= self.chunk_size:
+                yield ''.join(buf)
+                buf, size = [], 0
+        else:
+            last = None
+        cursor = None if last is None else self.encode(key(last))
+        buf.append('], "next": %s}' % json.dumps(cursor))
+        yield ''.join(buf)
+
+
+class Fields:
+    """sparse fieldsets, `?fields=name,price,author(name,email),tags.name`
+    is parsed into a tree, `{}` stands for the whole value
+
+    Example:
+
+        def show(product_id, fields, db):
+            return db.products.find_one(product_id, fields.paths())
+    """
+
+    def __init__(self, req, json_encoder):
+        self.json_encoder = json_encoder
+        self.tree = None
+        if req.query.get('fields'):
+            try:
+                self.tree = parse_fields(req.query['fields'])
+            except ValueError:
+                raise HttpError(400, "invalid fields %s"
+                                % req.query['fields'])
+
+    def __bool__(self):
+        return self.tree is not None
+
+    def paths(self, tree=None, prefix=''):
+        "selected fields as dotted paths"
+        paths, tree = [], self.tree if tree is None else tree
+        for name, sub in (tree or {}).items():
+            if sub:
+                paths.extend(self.paths(sub, prefix + name + '.'))
+            else:
+                paths.append(prefix + name)
+        return paths
+
+    def project(self, value, tree=None):
+        "drop unselected fields, before they get encoded"
+        tree = self.tree if tree is None else tree
+        if not tree:
+            return value
+        if type(value) in (list, tuple):
+            return [self.project(item, tree) for item in value]
+        if type(value) not in (dict, str, int, float, bool) and \
+                value is not None:
+            value = self.json_encoder().default(value)
+            return self.project(value, tree)
+        if type(value) is not dict:
+            return value
+        return {name: self.project(value[name], sub)
+                for name, sub in tree.items() if name in value}
+
+    def check(self, schema, tree=None):
+        "make sure selected fields are declared in schema"
+        for name, sub in (self.tree if tree is None else tree).items():
+            while schema.get('type') == 'array' and 'items' in schema:
+                schema = schema['items']
+            properties = schema.get('properties', {})
+            if name not in properties:
+                raise HttpError(400, "unknown field %s" % name)
+            if sub:
+                self.check(properties[name], sub)
+
+
+class Deferred:
+    """callables to run once the response body is closed,
+    arguments are resolved when a callable is registered
+
+    Example:
+
+        @get('/article/<article_id>')
+        def show(article_id, res):
+            res.defer(audit, action='show', target=article_id)
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.tasks = []
+
+    def __call__(self, fn, **kwargs):
+        self.tasks.append(partial(fn, **resolve_args(fn, kwargs,
+                                                     self.provider)))
+        return fn
+
+    def run(self):
+        for task in self.tasks:
+            try:
+                task()
+            except Exception:
+                self.provider.logger.error('Error in deferred task',
+                                           exc_info=True)
+        self.tasks = []
+
+
+class Stream:
+    "response body sent chunk by chunk"
+
+    def __init__(self, chunks, content_type=None):
+        self.chunks = chunks
+        self.content_type = content_type
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield chunk.encode('utf-8') if type(chunk) is str else chunk
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+
+class ClosingIterator:
+    """response iterable calling `callback` when the server closes it,
+    `size` counts the bytes served so far"""
+
+    def __init__(self, iterable, callback):
+        self.iterable = iterable
+        self.callback = callback
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.callback()
+
+
+def on_close(chunks, callback):
+    """call `callback(size)` once the response `chunks` are served, right
+    away for a list, when the server closes anything else"""
+    if type(chunks) is list:
+        callback(sum(len(chunk) for chunk in chunks))
+        return chunks
+    closing = ClosingIterator(chunks, lambda: callback(closing.size))
+    return closing
+
+
+def capture_status(start_response, status, *headers):
+    "`start_response` appending the status line to `status` and `headers`"
+    def capture(code, response_headers, *args):
+        status.append(code)
+        response_headers.extend(headers)
+        return start_response(code, response_headers, *args)
+    return capture
+
+
+def status_code(status):
+    "code of a status line captured by `capture_status`, 500 when missing"
+    return int(status[0].split(' ', 1)[0]) if status else 500
+
 
 class JSONEncoder(json.JSONEncoder):
 
@@ -638,6 +2031,11 @@ class JSONEncoder(json.JSONEncoder):
 
 def invoke(fn, *param_dicts):
     "call a function with a list of dicts providing params"
+    return fn(**resolve_args(fn, *param_dicts))
+
+
+def resolve_args(fn, *param_dicts):
+    "get arguments of a function from a list of dicts providing params"
     prepared_params = {}
     args = get_args(fn)
     defaults = get_arg_defaults(fn)
@@ -654,7 +2052,7 @@ def invoke(fn, *param_dicts):
                 prepared_params[name] = defaults[name]
             else:
                 raise Exception("%s is required" % name)
-    return fn(**prepared_params)
+    return prepared_params
 
 
 def instance(cls, *param_dicts):
@@ -665,6 +2063,77 @@ def instance(cls, *param_dicts):
         return cls()
 
 
+_validators = {}
+
+
+def get_validator(schema):
+    "get a validator for a schema, the schema is checked only once"
+    cached = _validators.get(id(schema))
+    if cached is None or cached[0] is not schema:
+        from jsonschema.exceptions import SchemaError as InvalidSchema
+        from jsonschema.validators import validator_for
+        cls = validator_for(schema)
+        try:
+            cls.check_schema(schema)
+        except InvalidSchema as e:
+            raise SchemaError(e.message)
+        cached = _validators[id(schema)] = schema, cls(schema)
+    return cached[1]
+
+
+def validate(instance, schema):
+    from jsonschema.exceptions import best_match
+    error = best_match(get_validator(schema).iter_errors(instance))
+    if error is not None:
+        raise ValidationError(error.message)
+
+
+_header_param = re.compile(
+    r';\s*([^=;\s]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+
+def parse_header(line):
+    "parse a header like Content-Type into a value and a dict of params"
+    value, _, params = line.partition(';')
+    return value.strip(), {
+        name.lower(): unquote_param(param.strip())
+        for name, param in _header_param.findall(';' + params)}
+
+
+def unquote_param(value):
+    if len(value) > 1 and value[0] == value[-1] == '"':
+        return value[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+    return value
+
+
+def parse_fields(text):
+    "parse `a,b.c,d(e,f)` into {'a': {}, 'b': {'c': {}}, 'd': {...}}"
+    root, last = {}, None
+    stack = [root]
+    for token in re.findall(r'[^,()]+|[,()]', text):
+        if token == '(':
+            if last is None:
+                raise ValueError(text)
+            stack.append(last)
+            last = None
+        elif token == ')':
+            if len(stack) == 1:
+                raise ValueError(text)
+            last = stack.pop()
+        elif token == ',':
+            last = None
+        else:
+            node = stack[-1]
+            for name in token.strip().split('.'):
+                if not name:
+                    raise ValueError(text)
+                node = node.setdefault(name, {})
+            last = node
+    if len(stack) != 1:
+        raise ValueError(text)
+    return root
+
+
 def get_arg_defaults(fn):
     "get arguments with default values as a dict"
     sig = inspect.signature(fn)
@@ -679,11 +2148,14 @@ def get_args(fn):
             if p.kind is p.POSITIONAL_OR_KEYWORD]
 
 
+_responses = {status.value: status.phrase for status in HTTPStatus}
+
+
 def get_status(code):
     "get status using http code"
-    if code not in http.client.responses:
+    if code not in _responses:
         raise HttpError(500, '%s is not a valide status code' % code)
-    return "%s %s" % (code, http.client.responses[code])
+    return "%s %s" % (code, _responses[code])
 
 
 def redirect(url, permanent=False):
@@ -696,6 +2168,7 @@ def static_handler(fs_root):
         raise HttpError(500, "static root %s should be a dir" % fs_root)
 
     def handler(url) -> etag:
+        import mimetypes
         fs_path = os.path.join(fs_root, url)
         if not os.path.isfile(fs_path):
             return 404, "%s not exists" % fs_path
@@ -717,9 +2190,24 @@ def load_config(logger):
         return {}
 
 
+def stream(template, chunk_size=8192):
+    """render a template into a streamed response, the document head
+    is flushed as soon as it's rendered
+
+    Example:
+
+        @get('/') -> stream(templates.home, chunk_size=4096):
+            return {"items": items}
+    """
+    def processer(res):
+        res.body = Stream(template.stream(res.body, chunk_size))
+    return processer
+
+
 def etag(res):
     "add Etag to response header if response code is 200"
     if res.code == 200 and res.body:
+        import zlib
         res.headers['Etag'] = "%X" % (zlib.crc32(bytes(res.body, "utf-8"))
                                       & 0xFFFFFFFF)
 
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import random
+import threading
+import tracemalloc
+
+from .klar import on_close
+
+
+class MemoryTracker:
+    """allocation deltas of handlers, response serialization and
+    component construction, aggregated by route and allocation site
+
+    `rate` of the requests take tracemalloc snapshots, retained memory is
+    measured for every request, a route is flagged as growing when it
+    retains memory on `window` requests in a row
+    """
+
+    def __init__(self, top=10, frames=1, rate=1, window=10, directory=None,
+                 interval=60):
+        self.top = top
+        self.rate = rate
+        self.window = window
+        self.directory = directory
+        self.interval = interval
+        self.dumped = time.monotonic()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.sites = {}
+        self.routes = {}
+        self.filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, __file__)]
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def middleware(self, app):
+        def track(environ, start_response):
+            self.local.sampled = random.random() < self.rate
+            before = tracemalloc.get_traced_memory()[0]
+            try:
+                chunks = app(environ, start_response)
+            finally:
+                self.local.sampled = False
+            return on_close(chunks, lambda size: self.retained(
+                environ, before))
+        return track
+
+    def wrap(self, process_request, provider):
+        "`process_request` measured as the handler phase"
+        def tracked():
+            if not getattr(self.local, 'sampled', False):
+                return process_request()
+            return self.measure(process_request, lambda: (
+                'handler', provider.environ.get('klar.route') or ''))
+        return tracked
+
+    def construct(self, name, build):
+        "provider hook measuring construction, wraps `res.output`"
+        if getattr(self.local, 'sampled', False):
+            instance = self.measure(build, ('construct', name))
+        else:
+            instance = build()
+        if name == 'res':
+            output = instance.output
+
+            def tracked():
+                if not getattr(self.local, 'sampled', False):
+                    return output()
+                return self.measure(output, lambda: (
+                    'output', instance.environ.get('klar.route') or ''))
+            instance.output = tracked
+        return instance
+
+    def measure(self, fn, key):
+        before = tracemalloc.take_snapshot().filter_traces(self.filters)
+        try:
+            return fn()
+        finally:
+            after = tracemalloc.take_snapshot().filter_traces(self.filters)
+            key = key() if callable(key) else key
+            diff = after.compare_to(before, 'lineno')
+            with self.lock:
+                sites = self.sites.setdefault(key, {})
+                for stat in diff:
+                    if stat.size_diff <= 0:
+                        continue
+                    site = str(stat.traceback[0])
+                    size, count = sites.get(site, (0, 0))
+                    sites[site] = (size + stat.size_diff,
+                                   count + stat.count_diff)
+                if len(sites) > self.top * 100:
+                    largest = sorted(sites.items(), key=lambda s: -s[1][0])
+                    self.sites[key] = dict(largest[:self.top * 10])
+
+    def retained(self, environ, before):
+        route = environ.get('klar.route') or ''
+        size = tracemalloc.get_traced_memory()[0] - before
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {
+                    'requests': 0, 'retained': 0, 'growing': 0}
+            stats['requests'] += 1
+            stats['retained'] += size
+            stats['growing'] = stats['growing'] + 1 if size > 0 else 0
+        if self.directory and time.monotonic() - self.dumped > self.interval:
+            self.dump()
+
+    def report(self, provider=None):
+        "top allocation sites by route and component, growing routes"
+        current, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            routes = {route: dict(stats, growing=stats['growing'] >=
+                                  self.window)
+                      for route, stats in self.routes.items()}
+            components = {}
+            for (phase, name), sites in self.sites.items():
+                largest = sorted(sites.items(), key=lambda s: -s[1][0])
+                top = [{'site': site, 'size': size, 'count': count}
+                       for site, (size, count) in largest[:self.top]]
+                if phase == 'construct':
+                    components[name] = top
+                else:
+                    routes.setdefault(name, {
+                        'requests': 0, 'retained': 0, 'growing': False})
+                    routes[name][phase] = top
+        report = {
+            'traced': current,
+            'peak': peak,
+            'routes': routes,
+            'components': components,
+            'growing': sorted(route for route, stats in routes.items()
+                              if stats['growing']),
+        }
+        if provider is not None and provider.accessed('cache'):
+            cache = provider.cache
+            if hasattr(cache, '__dict__'):
+                report['cache_entries'] = len(vars(cache))
+        return report
+
+    def dump(self):
+        self.dumped = time.monotonic()
+        filename = os.path.join(self.directory, 'memory-%s.json' % os.getpid())
+        with open(filename + '.tmp', 'w') as fp:
+            json.dump(self.report(), fp)
+        os.replace(filename + '.tmp', filename)
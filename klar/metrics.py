@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+
+from .klar import on_close, capture_status, status_code
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    """request counts, latency histograms, request/response sizes,
+    in-flight requests and component constructions
+
+    when `directory` is given, every process writes its metrics to
+    `<directory>/<pid>.json` at most every `interval` seconds, and
+    scrapes add up the metrics of all processes
+    """
+
+    def __init__(self, buckets=BUCKETS, directory=None, interval=5):
+        self.buckets = tuple(buckets)
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.request_size = {}
+        self.response_size = {}
+        self.constructed = {}
+        self.in_flight = 0
+        self.dumped = time.monotonic()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def middleware(self, app):
+        def metrics(environ, start_response):
+            start = time.perf_counter()
+            status = []
+            with self.lock:
+                self.in_flight += 1
+            try:
+                chunks = app(environ, capture_status(start_response, status))
+            except Exception:
+                with self.lock:
+                    self.in_flight -= 1
+                raise
+            return on_close(chunks, lambda size: self.observe(
+                environ, status, start, size))
+        return metrics
+
+    def observe(self, environ, status, start, response_size):
+        seconds = time.perf_counter() - start
+        route = environ.get('klar.route') or ''
+        method = environ.get('REQUEST_METHOD', '')
+        code = str(status_code(status))
+        try:
+            request_size = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            request_size = 0
+        key = route, method
+        with self.lock:
+            self.in_flight -= 1
+            self.requests[key + (code,)] = \
+                self.requests.get(key + (code,), 0) + 1
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+            for sizes, size in ((self.request_size, request_size),
+                                (self.response_size, response_size)):
+                total = sizes.get(key)
+                if total is None:
+                    total = sizes[key] = [0, 0]
+                total[0] += size
+                total[1] += 1
+        if self.directory and time.monotonic() - self.dumped > self.interval:
+            self.dump()
+
+    def construct(self, name, build):
+        "provider hook counting component constructions"
+        with self.lock:
+            self.constructed[name] = self.constructed.get(name, 0) + 1
+        return build()
+
+    def state(self):
+        with self.lock:
+            return {
+                'requests': [list(k) + [v] for k, v in self.requests.items()],
+                'latency': [list(k) + [v] for k, v in self.latency.items()],
+                'request_size': [list(k) + [v] for k, v in
+                                 self.request_size.items()],
+                'response_size': [list(k) + [v] for k, v in
+                                  self.response_size.items()],
+                'constructed': self.constructed.copy(),
+                'in_flight': self.in_flight,
+            }
+
+    def dump(self):
+        self.dumped = time.monotonic()
+        filename = os.path.join(self.directory, '%s.json' % os.getpid())
+        with open(filename + '.tmp', 'w') as fp:
+            json.dump(self.state(), fp)
+        os.replace(filename + '.tmp', filename)
+
+    def collect(self):
+        "metrics of this process, or of all processes sharing directory"
+        if not self.directory:
+            return [self.state()]
+        self.dump()
+        states = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as fp:
+                    state = json.load(fp)
+            except (OSError, ValueError):
+                continue
+            if not alive(int(filename[:-5])):
+                state['in_flight'] = 0
+            states.append(state)
+        return states
+
+    def render(self, provider=None):
+        "metrics in prometheus text format"
+        requests, latency, request_size, response_size = {}, {}, {}, {}
+        constructed, in_flight = {}, 0
+        for state in self.collect():
+            for *key, count in state['requests']:
+                key = tuple(key)
+                requests[key] = requests.get(key, 0) + count
+            for merged, rows in ((latency, state['latency']),
+                                 (request_size, state['request_size']),
+                                 (response_size, state['response_size'])):
+                for route, method, values in rows:
+                    total = merged.get((route, method))
+                    merged[route, method] = values if total is None else \
+                        [a + b for a, b in zip(total, values)]
+            for name, count in state['constructed'].items():
+                constructed[name] = constructed.get(name, 0) + count
+            in_flight += state['in_flight']
+
+        lines = [
+            '# HELP klar_requests_total Requests handled.',
+            '# TYPE klar_requests_total counter',
+        ]
+        for (route, method, code), count in sorted(requests.items()):
+            lines.append('klar_requests_total{%s} %s' % (labels(
+                route=route, method=method, status=code), count))
+
+        lines += [
+            '# HELP klar_request_duration_seconds Time spent on requests.',
+            '# TYPE klar_request_duration_seconds histogram',
+        ]
+        for (route, method), values in sorted(latency.items()):
+            cumulative = 0
+            for le, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                cumulative += count
+                lines.append('klar_request_duration_seconds_bucket{%s} %s' % (
+                    labels(route=route, method=method, le=le), cumulative))
+            label = labels(route=route, method=method)
+            lines.append('klar_request_duration_seconds_sum{%s} %s'
+                         % (label, values[-1]))
+            lines.append('klar_request_duration_seconds_count{%s} %s'
+                         % (label, cumulative))
+
+        for name, sizes in (('request', request_size),
+                            ('response', response_size)):
+            metric = 'klar_%s_size_bytes' % name
+            lines += ['# HELP %s Size of %s bodies.' % (metric, name),
+                      '# TYPE %s summary' % metric]
+            for (route, method), (total, count) in sorted(sizes.items()):
+                label = labels(route=route, method=method)
+                lines.append('%s_sum{%s} %s' % (metric, label, total))
+                lines.append('%s_count{%s} %s' % (metric, label, count))
+
+        lines += [
+            '# HELP klar_requests_in_flight Requests being handled.',
+            '# TYPE klar_requests_in_flight gauge',
+            'klar_requests_in_flight %s' % in_flight,
+            '# HELP klar_components_constructed_total Components built.',
+            '# TYPE klar_components_constructed_total counter',
+        ]
+        for name, count in sorted(constructed.items()):
+            lines.append('klar_components_constructed_total{%s} %s'
+                         % (labels(component=name), count))
+
+        if provider is not None:
+            lines += component_metrics(provider)
+        return '\n'.join(lines) + '\n'
+
+
+def component_metrics(provider):
+    "stats of memoizer, workers and pools of this process"
+    lines = []
+    if provider.accessed('memoizer'):
+        stats = provider.memoizer.stats()
+        for name in ('hits', 'misses', 'coalesced'):
+            lines += ['# TYPE klar_memoize_%s_total counter' % name,
+                      'klar_memoize_%s_total %s' % (name, stats[name])]
+        lines += ['# TYPE klar_memoize_hit_ratio gauge',
+                  'klar_memoize_hit_ratio %s' % stats['hit_ratio']]
+    if provider.accessed('workers'):
+        stats = provider.workers.stats()
+        lines += ['# TYPE klar_workers_queue_depth gauge',
+                  'klar_workers_queue_depth %s' % stats['depth']]
+        for name in ('processed', 'errors', 'dropped', 'spilled'):
+            lines += ['# TYPE klar_workers_%s_total counter' % name,
+                      'klar_workers_%s_total %s' % (name, stats[name])]
+    for name, pool in sorted(provider.__pools__.items()):
+        stats = pool.stats()
+        for key in ('idle', 'leased'):
+            lines.append('klar_pool_%s{%s} %s' % (key, labels(pool=name),
+                                                  stats[key]))
+        lines.append('klar_pool_exhausted_total{%s} %s'
+                     % (labels(pool=name), stats['exhausted']))
+    return lines
+
+
+def labels(**kwargs):
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"').replace('\n', '\\n'))
+                    for key, value in kwargs.items())
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
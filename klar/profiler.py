@@ -0,0 +1,147 @@
+import os
+import re
+import sys
+import hmac
+import time
+import random
+import hashlib
+import threading
+
+
+class Profiler:
+    """profiles single requests, picked by a signed header, a sampling
+    `rate` or a list of `routes`, results are written to `directory`
+
+    with mode `cprofile` a pstats file is written per request, with mode
+    `sample` the request thread's stack is sampled every `interval`
+    seconds and written as collapsed stacks, ready for flamegraph.pl
+    """
+
+    def __init__(self, directory, secret=None, rate=0, routes=(),
+                 mode='cprofile', interval=0.001, max_age=300,
+                 header='X-Klar-Profile'):
+        if mode not in ('cprofile', 'sample'):
+            raise ValueError('unknown profiling mode: %s' % mode)
+        self.directory = directory
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.rate = rate
+        self.routes = set(routes)
+        self.mode = mode
+        self.interval = interval
+        self.max_age = max_age
+        self.header = header
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def sign(self, method, path, timestamp=None):
+        "value of the header that triggers profiling of a request"
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        message = ('%s:%s:%s' % (timestamp, method.upper(), path)).encode()
+        return '%s:%s' % (timestamp, hmac.new(
+            self.secret, message, hashlib.sha256).hexdigest())
+
+    def verify(self, req):
+        value = req.header(self.header)
+        if not value or not self.secret:
+            return False
+        timestamp, _, _ = value.partition(':')
+        try:
+            age = time.time() - int(timestamp)
+        except ValueError:
+            return False
+        if not 0 <= age <= self.max_age:
+            return False
+        return hmac.compare_digest(
+            value, self.sign(req.method, req.path, timestamp))
+
+    def wanted(self, provider):
+        req = provider.req
+        if self.secret and self.verify(req):
+            return True
+        if self.rate and random.random() < self.rate:
+            return True
+        if self.routes:
+            router = provider.router
+            handler, _ = router.match(req.method, req.path)
+            return router.patterns.get(handler) in self.routes
+        return False
+
+    def wrap(self, process_request, provider):
+        "`process_request` profiled when wanted"
+        def profiled():
+            if not self.wanted(provider):
+                return process_request()
+            if self.mode == 'sample':
+                return self.sample(process_request, provider)
+            # only one cProfile can be active in a process
+            if not self.lock.acquire(blocking=False):
+                return process_request()
+            try:
+                return self.cprofile(process_request, provider)
+            finally:
+                self.lock.release()
+        return profiled
+
+    def cprofile(self, process_request, provider):
+        import cProfile
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            return process_request()
+        finally:
+            profile.disable()
+            profile.dump_stats(self.filename(provider, start) + '.pstats')
+
+    def sample(self, process_request, provider):
+        sampler = Sampler(threading.get_ident(), sys._getframe(),
+                          self.interval)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            return process_request()
+        finally:
+            sampler.stop()
+            with open(self.filename(provider, start) + '.collapsed',
+                      'w') as fp:
+                for stack, count in sorted(sampler.stacks.items()):
+                    fp.write('%s %d\n' % (stack, count))
+
+    def filename(self, provider, start):
+        "<time>-<pid>-<method>-<route>-<ms>ms"
+        elapsed = (time.perf_counter() - start) * 1000
+        route = provider.environ.get('klar.route') or 'unmatched'
+        route = re.sub(r'\W+', '_', route).strip('_') or 'root'
+        return os.path.join(self.directory, '%d-%d-%s-%s-%dms' % (
+            time.time() * 1000, os.getpid(), provider.req.method, route,
+            elapsed))
+
+
+class Sampler(threading.Thread):
+    "samples the stack of a thread, up to the frame `top`"
+
+    def __init__(self, target, top, interval):
+        super().__init__(daemon=True)
+        self.target = target
+        self.top = top
+        self.interval = interval
+        self.stacks = {}
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None and frame is not self.top:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
@@ -0,0 +1,297 @@
+"""record sampled traffic, replay it against an app and compare
+
+    recorder = app.record('/var/log/klar/traffic.jsonl', rate=0.05)
+
+    results = replay('traffic.jsonl', app=app, speed=10)
+    print(format_diff(diff(results)))
+"""
+
+import io
+import re
+import atexit
+import json
+import time
+import base64
+import random
+import threading
+from urllib import parse
+from http.client import HTTPConnection
+from concurrent.futures import ThreadPoolExecutor
+
+from .cli import percentile
+from .klar import on_close, capture_status, status_code
+
+SECRET_HEADERS = ('authorization', 'proxy-authorization', 'cookie',
+                  'x-api-key', 'x-auth-token', 'x-klar-profile')
+SECRET_FIELDS = re.compile(r'pass|secret|token|key|auth|credential', re.I)
+REDACTED = '[redacted]'
+
+
+class Recorder:
+    """middleware writing `rate` of the requests to `filename`, one json
+    object per line, secrets in headers, query strings and json bodies
+    are redacted, bodies larger than `max_body` are left out"""
+
+    def __init__(self, filename, rate=1.0, max_body=65536,
+                 headers=SECRET_HEADERS, fields=SECRET_FIELDS):
+        self.rate = rate
+        self.max_body = max_body
+        self.headers = {'HTTP_' + name.replace('-', '_').upper()
+                        for name in headers}
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.fp = open(filename, 'a')
+        atexit.register(self.close)
+
+    def middleware(self, app):
+        def record(environ, start_response):
+            if self.rate < 1 and random.random() >= self.rate:
+                return app(environ, start_response)
+            entry = self.request(environ)
+            status = []
+            start = time.perf_counter()
+            chunks = app(environ, capture_status(start_response, status))
+
+            def done(size):
+                entry.update(route=environ.get('klar.route'),
+                             status=status_code(status), size=size,
+                             latency=round(time.perf_counter() - start, 6))
+                self.write(entry)
+            return on_close(chunks, done)
+        return record
+
+    def request(self, environ):
+        "the replayable part of a request, with the body put back"
+        headers = {}
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                name = key[5:].replace('_', '-').title()
+                headers[name] = REDACTED if key in self.headers else value
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        entry = {
+            'time': time.time(),
+            'method': environ.get('REQUEST_METHOD', 'GET'),
+            'path': environ.get('PATH_INFO', '/'),
+            'query': self.redact_query(environ.get('QUERY_STRING', '')),
+            'headers': headers,
+        }
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length:
+            body = environ['wsgi.input'].read(length)
+            environ['wsgi.input'] = io.BytesIO(body)
+            if length > self.max_body:
+                entry['body_omitted'] = length
+            else:
+                self.add_body(entry, body, headers.get('Content-Type', ''))
+        return entry
+
+    def add_body(self, entry, body, content_type):
+        if content_type.startswith('application/json'):
+            try:
+                entry['body'] = json.dumps(self.redact(json.loads(
+                    body.decode('utf-8'))))
+                return
+            except ValueError:
+                pass
+        elif content_type.startswith('application/x-www-form-urlencoded'):
+            entry['body'] = self.redact_query(body.decode('latin-1'))
+            return
+        try:
+            entry['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            entry['body_base64'] = base64.b64encode(body).decode('ascii')
+
+    def redact(self, value):
+        if isinstance(value, dict):
+            return {key: REDACTED if self.fields.search(key)
+                    else self.redact(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.redact(item) for item in value]
+        return value
+
+    def redact_query(self, query):
+        if not query:
+            return query
+        return parse.urlencode([
+            (key, REDACTED if self.fields.search(key) else value)
+            for key, value in parse.parse_qsl(query, keep_blank_values=True)])
+
+    def write(self, entry):
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.fp.write(line)
+
+    def flush(self):
+        with self.lock:
+            self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+def load(filename):
+    "recorded entries, oldest first"
+    with open(filename) as fp:
+        entries = [json.loads(line) for line in fp if line.strip()]
+    return sorted(entries, key=lambda entry: entry['time'])
+
+
+def body_of(entry):
+    if 'body_base64' in entry:
+        return base64.b64decode(entry['body_base64'])
+    return entry.get('body', '').encode('utf-8')
+
+
+def environ_of(entry):
+    body = body_of(entry)
+    environ = {
+        'REQUEST_METHOD': entry['method'],
+        'PATH_INFO': entry['path'],
+        'QUERY_STRING': entry.get('query', ''),
+        'CONTENT_TYPE': entry['headers'].get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.url_scheme': 'http',
+    }
+    for name, value in entry['headers'].items():
+        if name != 'Content-Type':
+            environ['HTTP_' + name.replace('-', '_').upper()] = value
+    return environ
+
+
+def send_local(app, entry):
+    status = []
+
+    def start_response(code, headers, exc_info=None):
+        status.append(code)
+
+    start = time.perf_counter()
+    chunks = app(environ_of(entry), start_response)
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return int(status[0].split(' ', 1)[0]), size, \
+        time.perf_counter() - start
+
+
+def send_http(host, port, local, entry):
+    connection = getattr(local, 'connection', None)
+    if connection is None:
+        connection = local.connection = HTTPConnection(host, port,
+                                                       timeout=30)
+    path = entry['path'] + ('?' + entry['query'] if entry.get('query')
+                            else '')
+    start = time.perf_counter()
+    try:
+        connection.request(entry['method'], path, body_of(entry) or None,
+                           entry['headers'])
+        response = connection.getresponse()
+        size = len(response.read())
+    except Exception:
+        connection.close()
+        raise
+    return response.status, size, time.perf_counter() - start
+
+
+def replay(filename, app=None, url=None, speed=1.0, concurrency=8):
+    """send recorded requests to `app` in-process, or over http to `url`,
+    `speed` 1 keeps the original pace, 10 is ten times faster, None sends
+    as fast as possible, returns entries with the replayed results"""
+    entries = load(filename)
+    if url:
+        url = parse.urlsplit(url)
+        local = threading.local()
+        send = lambda entry: send_http(url.hostname, url.port or 80,
+                                       local, entry)
+    else:
+        send = lambda entry: send_local(app, entry)
+
+    def run(entry, at):
+        if at is not None:
+            delay = at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            status, size, latency = send(entry)
+        except Exception as e:
+            return dict(entry, replayed={'error': type(e).__name__})
+        return dict(entry, replayed={'status': status, 'size': size,
+                                     'latency': round(latency, 6)})
+
+    if not entries:
+        return []
+    first, started = entries[0]['time'], time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = [executor.submit(
+            run, entry, None if not speed
+            else started + (entry['time'] - first) / speed)
+            for entry in entries]
+        return [future.result() for future in futures]
+
+
+def latency_summary(latencies):
+    ordered = sorted(latencies)
+    return {name: round(percentile(ordered, p) * 1000, 3) if ordered
+            else None
+            for name, p in (('p50', 50), ('p90', 90), ('p99', 99))}
+
+
+def diff(results):
+    """latency percentiles and statuses of the recording against the
+    replay, overall and by route"""
+    routes = {}
+    for entry in results:
+        routes.setdefault(entry.get('route') or entry['path'], []) \
+            .append(entry)
+
+    def compare(entries):
+        replayed = [e['replayed'] for e in entries
+                    if 'latency' in e['replayed']]
+        return {
+            'requests': len(entries),
+            'recorded': latency_summary([e['latency'] for e in entries]),
+            'replayed': latency_summary([r['latency'] for r in replayed]),
+            'errors': len(entries) - len(replayed),
+        }
+
+    mismatches = [{
+        'method': entry['method'], 'path': entry['path'],
+        'recorded': entry['status'],
+        'replayed': entry['replayed'].get('status',
+                                          entry['replayed'].get('error')),
+    } for entry in results
+        if entry['replayed'].get('status') != entry['status']]
+    return dict(compare(results),
+                routes={route: compare(entries)
+                        for route, entries in sorted(routes.items())},
+                mismatches=mismatches)
+
+
+def format_diff(report):
+    def line(name, stats):
+        return '%-32s %6d  %s' % (name, stats['requests'], '  '.join(
+            '%s %s -> %s' % (p, fmt(stats['recorded'][p]),
+                             fmt(stats['replayed'][p]))
+            for p in ('p50', 'p90', 'p99')))
+
+    def fmt(value):
+        return '-' if value is None else '%.2fms' % value
+
+    lines = [line('all', report)]
+    lines += [line(route, stats) for route, stats in report['routes'].items()]
+    lines.append('status mismatches %d, errors %d' % (
+        len(report['mismatches']), report['errors']))
+    lines += ['  %(method)s %(path)s %(recorded)s -> %(replayed)s' % m
+              for m in report['mismatches'][:20]]
+    return '\n'.join(lines)
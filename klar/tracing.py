@@ -0,0 +1,256 @@
+import re
+import json
+import time
+import random
+import atexit
+import threading
+
+from .klar import capture_status, status_code
+
+
+TRACEPARENT = re.compile(
+    r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+
+class Span:
+    "a timed operation within a trace, usable as a context manager"
+
+    def __init__(self, tracer, name, trace_id, parent_id=None,
+                 attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def end(self):
+        self.duration = time.perf_counter() - self.started
+        self.tracer.finish(self)
+
+    @property
+    def traceparent(self):
+        return '00-%s-%s-01' % (self.trace_id, self.span_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.end()
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+
+
+class NoSpan:
+    "stands in for spans of requests that are not sampled"
+
+    traceparent = None
+
+    def set(self, key, value):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+no_span = NoSpan()
+
+
+class Tracer:
+    """records spans of sampled requests, finished spans are exported
+    to `sink` in batches of `batch_size` or every `interval` seconds,
+    when `max_buffer` spans are waiting new ones are dropped and counted
+
+    a request carrying a sampled `traceparent` header is always traced,
+    other requests are traced at `rate`
+    """
+
+    def __init__(self, sink=None, rate=1.0, batch_size=100, interval=1,
+                 max_buffer=10000):
+        self.sink = MemorySink() if sink is None else sink
+        self.rate = rate
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.dropped = 0
+        self.errors = 0
+        self.ready = threading.Event()
+        self.exporter = None
+        atexit.register(self.flush)
+
+    @property
+    def current(self):
+        "innermost open span of this thread"
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def span(self, name, **attributes):
+        """start a child of the current span
+
+        Example:
+
+            with tracer.span('db.query', table='products'):
+                pass
+        """
+        parent = self.current
+        if parent is None:
+            return no_span
+        span = Span(self, name, parent.trace_id, parent.span_id, attributes)
+        self.local.stack.append(span)
+        return span
+
+    def start(self, name, traceparent=None, **attributes):
+        "start a root span, or a child of a remote `traceparent`"
+        match = TRACEPARENT.match(traceparent or '')
+        if match and match.group(1) != '0' * 32:
+            trace_id, parent_id, flags = match.groups()
+            if not int(flags, 16) & 1:
+                self.local.stack = []
+                return no_span
+        elif self.rate and random.random() < self.rate:
+            trace_id, parent_id = '%032x' % random.getrandbits(128), None
+        else:
+            self.local.stack = []
+            return no_span
+        span = Span(self, name, trace_id, parent_id, attributes)
+        self.local.stack = [span]
+        return span
+
+    def traceparent(self):
+        "header value to pass the current trace on to other services"
+        span = self.current
+        return span.traceparent if span is not None else None
+
+    def finish(self, span):
+        stack = self.local.stack
+        if span in stack:
+            del stack[stack.index(span):]
+        with self.lock:
+            if len(self.buffer) >= self.max_buffer:
+                self.dropped += 1
+            else:
+                self.buffer.append(span)
+            full = len(self.buffer) >= self.batch_size
+            if self.exporter is None:
+                self.exporter = threading.Thread(target=self.export,
+                                                 daemon=True)
+                self.exporter.start()
+        if full:
+            self.ready.set()
+
+    def export(self):
+        while True:
+            self.ready.wait(self.interval)
+            self.ready.clear()
+            try:
+                self.flush()
+            except Exception:
+                # the spans are lost, the exporter carries on
+                with self.lock:
+                    self.errors += 1
+
+    def flush(self):
+        "export finished spans now"
+        with self.lock:
+            spans, self.buffer = self.buffer, []
+        if spans:
+            try:
+                self.sink.export([span.to_dict() for span in spans])
+            except Exception:
+                with self.lock:
+                    self.dropped += len(spans)
+                raise
+
+    def stats(self):
+        with self.lock:
+            return {'buffered': len(self.buffer), 'dropped': self.dropped,
+                    'errors': self.errors}
+
+    def wrap(self, name, fn, **attributes):
+        "`fn` traced as `name` when the current request is sampled"
+        def traced(*args, **kwargs):
+            if self.current is None:
+                return fn(*args, **kwargs)
+            with self.span(name, **attributes):
+                return fn(*args, **kwargs)
+        return traced
+
+    def middleware(self, app):
+        def trace(environ, start_response):
+            span = self.start('request', environ.get('HTTP_TRACEPARENT'),
+                              method=environ.get('REQUEST_METHOD'),
+                              path=environ.get('PATH_INFO'))
+            if span is no_span:
+                return app(environ, start_response)
+            status = []
+            try:
+                return app(environ, capture_status(start_response, status))
+            finally:
+                if status:
+                    span.set('status', status_code(status))
+                span.set('route', environ.get('klar.route'))
+                span.end()
+        return trace
+
+    def construct(self, name, build):
+        "provider hook tracing construction, and phases of components"
+        if self.current is None:
+            instance = build()
+        else:
+            with self.span('provide', component=name):
+                instance = build()
+        if name == 'res':
+            instance.pipe = self.wrap('pipe', instance.pipe)
+            instance.output = self.wrap('serialize', instance.output)
+        elif name == 'session':
+            instance.flush = self.wrap('session.flush', instance.flush)
+        return instance
+
+
+class MemorySink:
+    "keeps exported spans in `spans`, for tests"
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+class JsonlSink:
+    "appends spans to a file, one json object per line"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span) + '\n' for span in spans)
+        with self.lock, open(self.filename, 'a') as fp:
+            fp.write(lines)
@@ -22,7 +22,7 @@ setup(
         'Programming Language :: Python :: 3.3',
         'Topic :: Internet :: WWW/HTTP :: WSGI'
     ],
-    # entry_points={
-    #     'console_scripts': ['klar=klar:cli'],
-    # },
+    entry_points={
+        'console_scripts': ['klar=klar.cli:main'],
+    },
 )
@@ -37,6 +37,8 @@ def request(app, path, content_type, query={}, body='', method="GET",
 
     body = app(env, start_response)
     ret['body'] = ''.join(map(lambda x: x.decode(), body))
+    if hasattr(body, 'close'):
+        body.close()
     return ret
 
 def json_request(**kwargs):
@@ -1,6 +1,7 @@
 from klar import App, method, etag
 from request import get, json_request, post, patch
 import json
+import time
 import datetime
 
 
@@ -364,3 +365,861 @@ class TestApp:
         res = get(app, '/last-modified', headers={"If-Modified-Since": 'yesterday'})
         assert res['body'] == 'content'
         assert res['status'].startswith('200')
+
+    def test_memoize(self):
+        app = App()
+        calls = []
+
+        @app.get('/product/<product_id>')
+        @app.memoize(ttl=60, tags=['product:{product_id}'])
+        def show(product_id, req):
+            calls.append(product_id)
+            return {'id': product_id}
+
+        assert get(app, '/product/1')['body'] == '{"id": "1"}'
+        assert get(app, '/product/1')['body'] == '{"id": "1"}'
+        assert get(app, '/product/2')['body'] == '{"id": "2"}'
+        assert calls == ['1', '2']
+
+        show.invalidate(product_id='1')
+        get(app, '/product/1')
+        assert calls == ['1', '2', '1']
+
+        app.provider.memoizer.invalidate_tag('product:2')
+        get(app, '/product/2')
+        assert calls == ['1', '2', '1', '2']
+
+        stats = app.provider.memoizer.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 4
+
+    def test_memoize_tuple(self):
+        from klar import redirect
+        app = App()
+        calls = []
+
+        @app.post('/product')
+        @app.memoize(key='created')
+        def create():
+            calls.append(1)
+            return 201, {'id': 1}, ('X-Foo', 'bar')
+
+        @app.get('/old')
+        @app.memoize(key='old')
+        def old():
+            calls.append(2)
+            return redirect('/new')
+
+        for _ in range(2):
+            res = post(app, '/product')
+            assert res['status'].startswith('201')
+            assert ('X-Foo', 'bar') in res['headers']
+            assert json.loads(res['body']) == {'id': 1}
+            res = get(app, '/old')
+            assert res['status'].startswith('302')
+            assert ('Location', '/new') in res['headers']
+        assert calls == [1, 2]
+
+        @app.memoize(key='pair')
+        def pair():
+            return 1, [2]
+
+        assert pair() == pair() == (1, [2])
+
+    def test_memoize_single_flight(self):
+        import threading
+        app = App()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        @app.memoize(key='slow:{n}')
+        def slow(n):
+            calls.append(n)
+            started.set()
+            release.wait(1)
+            return n * 2
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow(2)))
+                   for _ in range(4)]
+        threads[0].start()
+        started.wait(1)
+        for t in threads[1:]:
+            t.start()
+        deadline = time.time() + 1
+        while app.provider.memoizer.coalesced < 3 and time.time() < deadline:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+        assert calls == [2]
+        assert results == [4, 4, 4, 4]
+
+        # a caller missing right before the previous flight stored its
+        # result finds it once it takes the slot
+        memoizer = app.provider.memoizer
+        load, misses = memoizer.load, []
+
+        def late_load(key, versions=None):
+            if not misses:
+                misses.append(key)
+                return False, None
+            return load(key, versions)
+
+        memoizer.load = late_load
+        assert slow(2) == 4
+        assert calls == [2] and misses == ['memo:slow:2']
+        assert memoizer.stats()['misses'] == 1
+
+    def test_background_event(self):
+        import threading
+        app = App()
+        seen = []
+
+        @app.get('/')
+        def home(emitter):
+            emitter.emit('visit', page='home')
+            return 'home'
+
+        @app.on('visit', background=True)
+        def record(page, req):
+            seen.append((page, req.path, threading.current_thread().name))
+
+        @app.on('visit', background=True)
+        def broken(page):
+            raise Exception('listener failed')
+
+        assert get(app, '/')['body'] == 'home'
+        app.provider.workers.join()
+        assert len(seen) == 1
+        page, path, thread = seen[0]
+        assert (page, path) == ('home', '/')
+        assert thread.startswith('klar-worker')
+        stats = app.provider.workers.stats()
+        assert stats['processed'] == 2
+        assert stats['errors'] == 1
+        assert stats['depth'] == 0
+
+    def test_defer(self):
+        app = App()
+        log = []
+
+        def audit(action, req):
+            log.append((action, req.path))
+
+        @app.get('/deferred')
+        def handler(res):
+            res.defer(audit, action='show')
+            res.defer(lambda: log.append('done'))
+            log.append('handler')
+            return 'ok'
+
+        @app.get('/d/<defer>')
+        def segment(defer):
+            return {'defer': defer}
+
+        response = app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/deferred',
+                        'QUERY_STRING': ''}, lambda status, headers: None)
+        assert log == ['handler']
+        assert list(response) == [b'ok']
+        response.close()
+        assert log == ['handler', ('show', '/deferred'), 'done']
+
+        log.clear()
+        assert get(app, '/deferred')['body'] == 'ok'
+        assert log == ['handler', ('show', '/deferred'), 'done']
+        assert json.loads(get(app, '/d/x')['body']) == {'defer': 'x'}
+
+    def test_template_streaming(self):
+        app = App()
+
+        import templates.page
+        from klar import stream, on_close
+        sizes = []
+        app.use(lambda wsgi: lambda environ, start_response: on_close(
+            wsgi(environ, start_response), sizes.append))
+
+        @app.get('/page')
+        def page() -> stream(templates.page, chunk_size=64):
+            return {"title": "<klar>", "content": "x" * 200}
+
+        response = app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/page',
+                        'QUERY_STRING': ''}, lambda status, headers: None)
+        chunks = list(response)
+        assert chunks[0] == b'<html><head><title>&lt;klar&gt;</title></head>'
+        assert len(chunks) > 2
+        assert b''.join(chunks).decode() == templates.page(
+            {"title": "<klar>", "content": "x" * 200})
+        assert sizes == []
+        response.close()
+        assert sizes == [len(b''.join(chunks))]
+
+    def test_freeze(self, tmp_path):
+        import pytest
+        from resources import post
+        snapshot = str(tmp_path / 'app.snapshot')
+
+        app = App(snapshot=snapshot)
+        app.resources(post, prefix='/v2')
+
+        @app.post('/create')
+        def create(body: {"type": "array"}):
+            return body
+
+        app.freeze()
+        assert app.plan_for(create).args == ['body']
+        with pytest.raises(RuntimeError):
+            app.get('/late', lambda: 'late')
+        with pytest.raises(RuntimeError):
+            app.provide('db', object)
+
+        app = App(snapshot=snapshot)
+        assert '/v2/post' in app.provider.rest.snapshot
+
+        def scan(url_path, module):
+            raise AssertionError('%s was scanned again' % url_path)
+        app.provider.rest.scan_resource = scan
+        app.resources(post, prefix='/v2')
+        app.freeze()
+        assert get(app, '/v2/post/31')['body'] == 'post: 31'
+        assert patch(app, '/v2/post/31/upvote')['body'] == 'upvote: 31'
+
+    def test_freeze_added_handler(self, tmp_path):
+        snapshot = str(tmp_path / 'app.snapshot')
+
+        class Article:
+            def show(article_id):
+                return 'show: %s' % article_id
+
+        app = App(snapshot=snapshot)
+        app.resource('/article', Article)
+        app.freeze()
+
+        class Article:
+            def show(article_id):
+                return 'show: %s' % article_id
+
+            @method('patch')
+            def upvote(article_id):
+                return 'upvote: %s' % article_id
+
+        app = App(snapshot=snapshot)
+        app.resource('/article', Article)
+        app.freeze()
+        assert get(app, '/article/1')['body'] == 'show: 1'
+        assert patch(app, '/article/1/upvote')['body'] == 'upvote: 1'
+
+    def test_loader(self):
+        app = App()
+        batches = []
+
+        @app.loader('users')
+        def load_users(keys, req):
+            batches.append(keys)
+            return {key: 'user%s' % key for key in keys if key != 3}
+
+        @app.get('/articles')
+        def articles(users):
+            pending = [users.load(key) for key in [1, 2, 1]]
+            names = [p.get() for p in pending]
+            return names + users.load_many([2, 3])
+
+        res = get(app, '/articles')
+        assert json.loads(res['body']) == ['user1', 'user2', 'user1',
+                                           'user2', None]
+        assert batches == [[1, 2], [3]]
+
+        get(app, '/articles')
+        assert batches == [[1, 2], [3], [1, 2], [3]]
+
+    def test_loader_async(self):
+        import asyncio
+        from klar import Loader
+        batches = []
+
+        def load(keys):
+            batches.append(keys)
+            return [key * 2 for key in keys]
+
+        loader = Loader(load, {})
+
+        async def fetch(key):
+            return await loader.load(key)
+
+        async def main():
+            return await asyncio.gather(*[fetch(key) for key in [1, 2, 3]])
+
+        assert asyncio.run(main()) == [2, 4, 6]
+        assert batches == [[1, 2, 3]]
+
+    def test_batched(self):
+        import threading
+        app = App()
+        batches = []
+
+        @app.get('/product/<product_id>')
+        @app.batched(max_size=3, max_wait_ms=1000)
+        def show(product_id, req, logger):
+            batches.append(product_id)
+            assert not isinstance(logger, list)
+            return ['product %s %s' % (id, r.header('X-Product'))
+                    for id, r in zip(product_id, req)]
+
+        results = {}
+
+        def fetch(id):
+            results[id] = get(app, '/product/%s' % id,
+                              headers={'X-Product': id})['body']
+
+        threads = [threading.Thread(target=fetch, args=(id,))
+                   for id in 'abc']
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert time.time() - start < 1
+        assert results == {id: 'product %s %s' % (id, id) for id in 'abc'}
+        assert len(batches) == 1 and sorted(batches[0]) == list('abc')
+
+    def test_batch(self):
+        app = App()
+
+        @app.resource('/v1/post')
+        class PostResource:
+            def show(post_id, req):
+                return {'id': post_id, 'token': req.header('X-Token')}
+
+            def modify(post_id, body):
+                return 'modified %s: %s' % (post_id, body['title'])
+
+        app.batch('/v1')
+        app.batch('/v2', parallel=True)
+        requests = [
+            {'method': 'GET', 'path': '/v1/post/1'},
+            {'method': 'PATCH', 'path': '/v1/post/2',
+             'body': {'title': 'batch'}},
+            {'path': '/v1/missing'},
+        ]
+        for path in ['/v1/_batch', '/v2/_batch']:
+            res = json_request(app=app, path=path, body=requests,
+                               headers={'X-Token': 'secret'})
+            assert res['status'] == '200 OK'
+            results = json.loads(res['body'])
+            assert [r['status'] for r in results] == [200, 200, 404]
+            assert results[0]['body'] == {'id': '1', 'token': 'secret'}
+            assert results[1]['body'] == 'modified 2: batch'
+
+        res = json_request(app=app, path='/v1/_batch', body={'path': '/'})
+        assert res['status'].startswith('400')
+
+        for path in ['/v1/_batch', '/v2/_batch?x=1']:
+            res = json_request(app=app, path='/v1/_batch',
+                               body=[{'method': 'POST', 'path': path,
+                                      'body': requests}])
+            assert json.loads(res['body'])[0]['status'] == 400
+
+    def test_pagination(self):
+        from klar import Page
+        app = App()
+        app.provide('page', Page, on_request=True)
+        products = [{'id': i} for i in range(1, 8)]
+
+        @app.get('/products')
+        def query(page):
+            after = page.after or 0
+            found = (p for p in products if p['id'] > after)
+            return page.results(found, key='id')
+
+        @app.get('/list')
+        def listing(page):
+            after = page.after or 0
+            return page.results([p for p in products if p['id'] > after
+                                 ][:page.limit + 1], key='id')
+
+        res = get(app, '/products', {'limit': 3})
+        assert res['headers'][0] == ('Content-Type',
+                                     'application/json; charset=utf-8')
+        body = json.loads(res['body'])
+        assert body['items'] == products[:3]
+
+        body = json.loads(get(app, '/products', {'limit': 3,
+                                                 'cursor': body['next']})['body'])
+        assert body['items'] == products[3:6]
+        body = json.loads(get(app, '/products', {'limit': 3,
+                                                 'cursor': body['next']})['body'])
+        assert body == {'items': products[6:], 'next': None}
+
+        body = json.loads(get(app, '/products', {'limit': 1000})['body'])
+        assert len(body['items']) == 7
+
+        res = get(app, '/list', {'limit': 5})
+        link = dict(res['headers'])['Link']
+        assert link.startswith('</list?') and link.endswith('; rel="next"')
+        assert json.loads(res['body'])['next'] in link
+
+        assert get(app, '/list', {'cursor': '!!'})['status'].startswith('400')
+        assert get(app, '/list', {'limit': 'x'})['status'].startswith('400')
+
+        # without registering Page, `page` stays a query parameter
+        app = App()
+
+        @app.get('/items')
+        def items(page: int = 1):
+            return {'page': page}
+
+        assert json.loads(get(app, '/items', {'page': 2})['body']) == {
+            'page': 2}
+        assert json.loads(get(app, '/items')['body']) == {'page': 1}
+
+    def test_fields(self):
+        from klar import Page
+        app = App()
+        app.sparse_fields()
+        app.provide('page', Page, on_request=True)
+        article = {'id': 1, 'title': 'klar', 'body': '...',
+                   'author': {'name': 'z', 'email': 'z@klar'},
+                   'tags': [{'name': 'web', 'count': 3}]}
+        schema = {'type': 'object', 'properties': {
+            'id': {}, 'title': {}, 'body': {}, 'tags': {
+                'type': 'array', 'items': {'properties': {'name': {}}}},
+            'author': {'properties': {'name': {}, 'email': {}}}}}
+
+        @app.get('/article')
+        def show(fields) -> schema:
+            assert fields.paths() in ([], ['title', 'author.name',
+                                           'tags.name'])
+            return article
+
+        @app.get('/articles')
+        def query(page):
+            return page.results([article, article], key='id')
+
+        fields = 'title,author(name),tags.name'
+        res = get(app, '/article', {'fields': fields})
+        assert json.loads(res['body']) == {
+            'title': 'klar', 'author': {'name': 'z'}, 'tags': [{'name': 'web'}]}
+        assert json.loads(get(app, '/article')['body']) == article
+
+        res = get(app, '/articles', {'fields': 'id,author.email'})
+        assert json.loads(res['body'])['items'] == [
+            {'id': 1, 'author': {'email': 'z@klar'}}] * 2
+
+        res = get(app, '/article', {'fields': 'title,author(age)'})
+        assert res['status'].startswith('400')
+        res = get(app, '/article', {'fields': 'title,(name'})
+        assert res['status'].startswith('400')
+
+        @app.get('/plain')
+        def plain():
+            return {'title': 'klar', 'body': '...'}
+
+        res = get(app, '/plain', {'fields': 'x,(y'})
+        assert res['status'].startswith('400')
+        res = get(app, '/plain', {'fields': 'title'})
+        assert json.loads(res['body']) == {'title': 'klar'}
+        res = get(app, '/plain', {'xfields': 'title'})
+        assert json.loads(res['body']) == {'title': 'klar', 'body': '...'}
+
+        # without sparse_fields, `fields` is an ordinary query parameter
+        app = App()
+        app.provide('page', Page, on_request=True)
+
+        @app.get('/f')
+        def f(fields='all'):
+            return {'fields': fields}
+
+        @app.get('/html')
+        def html():
+            return '<p>klar</p>'
+
+        @app.get('/articles')
+        def articles(page):
+            return page.results([article], key='id')
+
+        res = get(app, '/f', {'fields': 'x'})
+        assert json.loads(res['body']) == {'fields': 'x'}
+        assert json.loads(get(app, '/f')['body']) == {'fields': 'all'}
+        assert get(app, '/html', {'fields': 'x,(y'})['body'] == '<p>klar</p>'
+        res = get(app, '/articles', {'fields': 'id'})
+        assert json.loads(res['body'])['items'] == [article]
+
+    def test_metrics(self, tmpdir):
+        app = App()
+        collector = app.metrics('/metrics', directory=str(tmpdir))
+
+        @app.get('/users/<id>')
+        def show(id: int, memoizer):
+            return {'id': id}
+
+        get(app, '/users/1')
+        get(app, '/users/2')
+        get(app, '/missing')
+        res = get(app, '/metrics')
+        assert res['status'].startswith('200')
+        assert ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8') \
+            in res['headers']
+        body = res['body']
+        assert ('klar_requests_total{route="/users/<id>",method="GET",'
+                'status="200"} 2') in body
+        assert 'klar_requests_total{route="",method="GET",status="404"} 1' \
+            in body
+        assert ('klar_request_duration_seconds_bucket{route="/users/<id>",'
+                'method="GET",le="+Inf"} 2') in body
+        assert ('klar_response_size_bytes_count{route="/users/<id>",'
+                'method="GET"} 2') in body
+        assert 'klar_requests_in_flight 1' in body
+        assert 'klar_components_constructed_total{component="memoizer"} 1' \
+            in body
+        assert 'klar_memoize_hit_ratio' in body
+        assert tmpdir.listdir()
+
+        other = type(collector)(directory=str(tmpdir))
+        other.requests[('/users/<id>', 'GET', '200')] = 3
+        with open(str(tmpdir.join('1.json')), 'w') as fp:
+            json.dump(other.state(), fp)
+        assert ('klar_requests_total{route="/users/<id>",method="GET",'
+                'status="200"} 5') in collector.render()
+
+    def test_profile(self, tmpdir):
+        app = App()
+        process_request = app.process_request
+
+        @app.get('/slow/<id>')
+        def slow(id: int):
+            time.sleep(0.02)
+            return 'slow'
+
+        @app.get('/fast')
+        def fast():
+            return 'fast'
+
+        profiles = tmpdir.join('profiles')
+        profiler = app.profile(str(profiles), secret='s3cret',
+                               routes=['/slow/<id>'])
+        assert app.process_request is not process_request
+
+        assert get(app, '/fast')['body'] == 'fast'
+        assert profiles.listdir() == []
+        get(app, '/fast', headers={'X-Klar-Profile': 'x'})
+        get(app, '/fast', headers={
+            'X-Klar-Profile': profiler.sign('GET', '/other')})
+        assert profiles.listdir() == []
+
+        get(app, '/fast', headers={
+            'X-Klar-Profile': profiler.sign('GET', '/fast')})
+        assert get(app, '/slow/1')['body'] == 'slow'
+        names = sorted(p.basename for p in profiles.listdir())
+        assert len(names) == 2
+        assert any('-GET-fast-' in name for name in names)
+        assert all(name.endswith('ms.pstats') for name in names)
+
+        import pstats
+        stats = pstats.Stats(str(profiles.listdir()[0]))
+        assert stats.total_calls
+
+        sampled = tmpdir.join('sampled')
+        app = App()
+        app.get('/slow/<id>', slow)
+        app.profile(str(sampled), rate=1, mode='sample', interval=0.001)
+        get(app, '/slow/1')
+        collapsed, = sampled.listdir()
+        assert '-GET-slow_id-' in collapsed.basename
+        stacks = collapsed.read().splitlines()
+        assert stacks
+        assert any('slow (test_app.py' in line for line in stacks)
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in stacks)
+
+    def test_track_memory(self):
+        import tracemalloc
+        tracing = tracemalloc.is_tracing()
+        app = App()
+        tracker = app.track_memory('/_memory', window=3)
+        leaked = []
+
+        @app.get('/leak')
+        def leak(cache):
+            leaked.append(bytearray(10000))
+            cache.set(len(leaked), 'x' * 1000)
+            return 'leak'
+
+        @app.get('/noop')
+        def noop():
+            return 'noop'
+
+        try:
+            for _ in range(4):
+                get(app, '/leak')
+            get(app, '/noop')
+            report = json.loads(get(app, '/_memory')['body'])
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+
+        assert report['growing'] == ['/leak']
+        leak_stats = report['routes']['/leak']
+        assert leak_stats['requests'] == 4
+        assert leak_stats['retained'] >= 40000
+        assert any('test_app.py' in site['site'] and site['size'] >= 10000
+                   for site in leak_stats['handler'])
+        assert 'output' in leak_stats
+        assert 'res' in report['components']
+        assert report['cache_entries'] == 4
+        assert not report['routes']['/noop']['growing']
+
+    def test_trace(self, tmpdir):
+        from klar.tracing import JsonlSink
+        app = App()
+        tracer = app.trace()
+
+        @app.post('/products/<id>')
+        def update(id: int, body: {'type': 'object'}, tracer, session):
+            with tracer.span('db.update', table='products') as span:
+                span.set('id', id)
+            session.set('seen', id)
+            return body
+
+        @app.get('/products/<id>')
+        def show(id: int):
+            raise Exception('boom')
+
+        parent = '00-%s-%s-01' % ('a' * 32, 'b' * 16)
+        res = json_request(app=app, path='/products/1', body={'x': 1},
+                           headers={'traceparent': parent})
+        assert res['status'].startswith('200')
+        tracer.flush()
+        spans = {span['name']: span for span in tracer.sink.spans}
+        root = spans['request']
+        assert root['trace_id'] == 'a' * 32
+        assert root['parent_id'] == 'b' * 16
+        assert root['attributes']['route'] == '/products/<id>'
+        assert root['attributes']['status'] == 200
+        for name in ('validate', 'handler', 'serialize', 'session.flush',
+                     'db.update', 'provide'):
+            assert spans[name]['trace_id'] == 'a' * 32
+        assert spans['handler']['parent_id'] == root['span_id']
+        assert spans['db.update']['parent_id'] == spans['handler']['span_id']
+        assert spans['db.update']['attributes'] == {
+            'table': 'products', 'id': 1}
+        assert all(span['duration'] >= 0 for span in spans.values())
+
+        tracer.sink.spans.clear()
+        get(app, '/products/1', headers={
+            'traceparent': '00-%s-%s-00' % ('a' * 32, 'b' * 16)})
+        tracer.flush()
+        assert tracer.sink.spans == []
+
+        filename = str(tmpdir.join('spans.jsonl'))
+        app = App()
+        app.get('/products/<id>', show)
+        tracer = app.trace(JsonlSink(filename), rate=1)
+        assert get(app, '/products/1')['status'].startswith('500')
+        tracer.flush()
+        with open(filename) as fp:
+            spans = {span['name']: span for span in map(json.loads, fp)}
+        assert spans['handler']['attributes']['error'] == 'Exception'
+        assert spans['request']['attributes']['status'] == 500
+        assert spans['request']['parent_id'] is None
+
+        app = App()
+        app.get('/products/<id>', show)
+        tracer = app.trace(rate=0)
+        get(app, '/products/1')
+        tracer.flush()
+        assert tracer.sink.spans == []
+
+    def test_trace_sink_errors(self):
+        import threading
+        from klar.tracing import Tracer
+
+        class Sink:
+            def __init__(self):
+                self.spans = []
+                self.failed = threading.Event()
+                self.exported = threading.Event()
+
+            def export(self, spans):
+                if not self.failed.is_set():
+                    self.failed.set()
+                    raise OSError('disk full')
+                self.spans.extend(spans)
+                self.exported.set()
+
+        sink = Sink()
+        tracer = Tracer(sink, interval=60, max_buffer=2)
+        for _ in range(3):
+            tracer.start('request').end()
+        assert tracer.stats() == {'buffered': 2, 'dropped': 1, 'errors': 0}
+        # the first export fails, the exporter goes on with the next one
+        tracer.ready.set()
+        assert sink.failed.wait(5)
+        tracer.start('request').end()
+        tracer.ready.set()
+        assert sink.exported.wait(5)
+        assert len(sink.spans) == 1
+        assert tracer.stats() == {'buffered': 0, 'dropped': 3, 'errors': 1}
+
+    def test_access_log(self, tmpdir):
+        filename = str(tmpdir.join('access.jsonl'))
+        app = App('access_log_app')
+        log = app.access_log(filename, routes={'/health': 0})
+
+        @app.get('/items/<id>')
+        def show(id: int):
+            return {'id': id}
+
+        @app.get('/health')
+        def health():
+            return 'ok'
+
+        @app.get('/fail')
+        def fail():
+            raise Exception('boom')
+
+        res = get(app, '/items/1', headers={'X-Request-Id': 'abc'})
+        assert ('X-Request-Id', 'abc') in res['headers']
+        get(app, '/health')
+        res = get(app, '/fail')
+        request_id = dict(res['headers'])['X-Request-Id']
+        log.flush()
+
+        with open(filename) as fp:
+            entries = [json.loads(line) for line in fp]
+        access = [e for e in entries if e['type'] == 'access']
+        assert [e['route'] for e in access] == ['/items/<id>', '/fail']
+        assert access[0]['request_id'] == 'abc'
+        assert access[0]['status'] == 200
+        assert access[0]['response_size'] == 9
+        assert access[0]['duration_ms'] >= 0
+        assert access[1]['status'] == 500
+        error, = [e for e in entries if e['type'] == 'log']
+        assert error['request_id'] == request_id
+        assert error['level'] == 'ERROR'
+        assert 'boom' in error['exception']
+        assert log.stats() == {'depth': 0, 'written': 3, 'dropped': 0}
+
+    def test_access_log_backpressure(self):
+        import io
+        import threading
+        from klar.accesslog import AccessLog
+        log = AccessLog(io.StringIO(), max_queue=2, batch_size=1)
+        writing = threading.Event()
+        blocked = threading.Event()
+
+        def write(batch):
+            writing.set()
+            blocked.wait()
+
+        log.write = write
+        try:
+            log.put({'i': 0})
+            assert writing.wait(2)
+            for i in range(1, 10):
+                log.put({'i': i})
+            assert log.dropped == 7
+            assert log.stats()['depth'] == 2
+        finally:
+            blocked.set()
+
+    def test_admission(self):
+        import threading
+        from klar.admission import default_priority
+        queued = {path: threading.Event() for path in ('/slow/2', '/slow/3')}
+
+        def priority(environ):
+            # called under the admission lock right before queuing
+            queued[environ['PATH_INFO']].set()
+            return default_priority(environ)
+
+        app = App()
+        admission = app.admission(limit=2, routes={'/slow/<id>': 1},
+                                  max_queue=2, timeout=0.2, retry_after=3,
+                                  priority=priority)
+        release = threading.Event()
+        started = threading.Event()
+
+        @app.get('/slow/<id>')
+        def slow(id: int):
+            started.set()
+            release.wait(2)
+            return 'slow'
+
+        @app.get('/fast')
+        def fast():
+            return 'fast'
+
+        @app.get('/health')
+        def health():
+            return 'ok'
+
+        results = {}
+
+        def call(name, path, **kwargs):
+            results[name] = get(app, path, **kwargs)
+
+        first = threading.Thread(target=call, args=('first', '/slow/1'))
+        first.start()
+        assert started.wait(2)
+        res = get(app, '/slow/2')
+        assert queued['/slow/2'].is_set()
+        assert res['status'].startswith('503')
+        assert ('Retry-After', '3') in res['headers']
+        assert get(app, '/fast')['body'] == 'fast'
+
+        second = threading.Thread(target=call, args=('second', '/slow/3'))
+        second.start()
+        assert queued['/slow/3'].wait(2)
+        assert admission.stats()['queued'] == 1
+        release.set()
+        first.join()
+        second.join()
+        assert results['first']['body'] == 'slow'
+        assert results['second']['body'] == 'slow'
+        stats = admission.stats()
+        assert stats['in_flight'] == 0 and stats['timed_out'] == 1
+
+    def test_admission_priority(self):
+        import threading
+        from klar.admission import Admission, default_priority
+        queued = threading.Event()
+
+        def priority(environ):
+            queued.set()
+            return default_priority(environ)
+
+        admission = Admission(limit=1, max_queue=1, timeout=1,
+                              priority=priority)
+        assert admission.acquire({'PATH_INFO': '/'}, None)
+        results = {}
+
+        def acquire(name, environ):
+            results[name] = admission.acquire(environ, None)
+
+        anonymous = threading.Thread(target=acquire, args=(
+            'anonymous', {'PATH_INFO': '/'}))
+        anonymous.start()
+        assert queued.wait(2)
+        health = threading.Thread(target=acquire, args=(
+            'health', {'PATH_INFO': '/health'}))
+        health.start()
+        # health checks take the place of the anonymous request
+        anonymous.join()
+        assert results == {'anonymous': False}
+        assert not admission.acquire({'PATH_INFO': '/x'}, None)
+        admission.release(None, time.perf_counter())
+        health.join()
+        assert results == {'anonymous': False, 'health': True}
+
+    def test_admission_adaptive(self):
+        from klar.admission import Admission
+        admission = Admission(limit=10, target_ms=10, window=2, min_limit=2)
+        for latency in (0.05, 0.05, 0.05, 0.05):
+            admission.adapt(latency)
+        assert admission.limit == 8
+        for _ in range(20):
+            admission.adapt(0.001)
+        assert admission.limit == 10
+        for _ in range(100):
+            admission.adapt(1)
+        assert admission.limit == 2
@@ -0,0 +1,62 @@
+import json
+from klar import App
+from klar.cli import main, load_requests, percentile
+
+app = App()
+
+
+@app.get('/')
+def index():
+    return 'index'
+
+
+@app.post('/echo')
+def echo(body):
+    return body
+
+
+@app.get('/fail')
+def fail():
+    raise Exception('fail')
+
+
+def test_load_requests(tmpdir):
+    scenario = tmpdir.join('scenario.json')
+    scenario.write(json.dumps([
+        {'path': '/', 'weight': 2},
+        {'method': 'post', 'path': '/echo', 'body': {'a': 1},
+         'query': {'x': 1}}]))
+    requests = load_requests(str(scenario))
+    assert len(requests) == 3
+    assert requests[0] == ('GET', '/', None, {})
+    assert requests[2] == ('POST', '/echo?x=1', b'{"a": 1}',
+                           {'Content-Type': 'application/json'})
+
+
+def test_percentile():
+    values = list(range(1, 1001))
+    assert percentile(values, 50) == 500
+    assert percentile(values, 99.9) == 999
+    assert percentile([3], 99) == 3
+    assert percentile([], 50) is None
+
+
+def test_bench(tmpdir, capsys):
+    scenario = tmpdir.join('scenario.json')
+    scenario.write(json.dumps({'requests': [
+        {'path': '/', 'weight': 3}, {'path': '/fail'},
+        {'method': 'POST', 'path': '/echo', 'body': {'a': 1}}]}))
+    assert main(['bench', 'test_cli:app', '--scenario', str(scenario),
+                 '-n', '50', '-c', '5', '--json']) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report['requests'] == 50
+    assert report['statuses'] == {'200': 40, '500': 10}
+    assert report['error_rate'] == 0.2
+    assert set(report['latency_ms']) == {'p50', 'p90', 'p99', 'p99.9'}
+    assert report['latency_ms']['p50'] <= report['latency_ms']['p99.9']
+    assert report['connections'] == 5
+
+    assert main(['bench', 'test_cli:app', '-d', '0.2', '-c', '2',
+                 '--server', 'simple']) == 0
+    out = capsys.readouterr().out
+    assert 'throughput' in out and 'p99.9' in out and '200:' in out
@@ -26,3 +26,37 @@ def test_instance():
     foo = instance(Foo, {'bar': 'bar'}, {'foo': 'foo'})
     assert foo.foo == 'foo'
     assert foo.bar == 'bar'
+
+def test_worker_pool_backpressure():
+    import logging
+    import threading
+    started = threading.Event()
+    release = threading.Event()
+    ran = []
+
+    def block():
+        started.set()
+        release.wait()
+
+    pool = WorkerPool(logging.getLogger('test'), size=1, max_queue=1,
+                      backpressure='drop')
+    pool.submit(block)
+    assert started.wait(2)
+    pool.submit(lambda: ran.append('queued'))
+    pool.submit(lambda: ran.append('dropped'))
+    assert pool.stats()['dropped'] == 1
+    release.set()
+    pool.join()
+    assert ran == ['queued']
+
+    pool.backpressure = 'spill'
+    started.clear()
+    release.clear()
+    pool.submit(block)
+    assert started.wait(2)
+    pool.submit(lambda: ran.append('queued'))
+    pool.submit(lambda: ran.append('spilled'))
+    assert ran == ['queued', 'spilled']
+    assert pool.stats()['spilled'] == 1
+    release.set()
+    pool.join()
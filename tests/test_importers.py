@@ -11,3 +11,65 @@ class TestImporters:
     def test_json_import(self):
         from schemas import product
         assert product['type'] == 'object'
+
+    def test_template_escape_types(self):
+        import templates.product
+        expected = "<p>&lt;b&gt;tea costs $3.5</p>\n"
+        assert templates.product({'name': '<b>tea', 'price': 3.5}) == expected
+        assert templates.product() == "<p>$name costs $$${price}</p>\n"
+
+    def test_mustache_import(self):
+        import templates.greeting
+        expected = '<p>&lt;klar&gt; """ 2</p>\n'
+        assert templates.greeting({'name': '<klar>', 'count': 2}) == expected
+
+    def test_jinja_import(self):
+        import templates.list
+        expected = "<ul><li>&lt;a&gt;</li><li>1</li></ul>\n"
+        assert templates.list({'items': ['<a>', 1]}) == expected
+
+    def test_finder_listing_cache(self, tmp_path, monkeypatch):
+        import os
+        from klar.importers import finder
+        monkeypatch.syspath_prepend(str(tmp_path))
+        (tmp_path / 'klar_first.json').write_text('{"first": 1}')
+        from klar_first import first
+        assert first == 1
+        assert os.path.join(str(tmp_path), 'klar_first.json') == \
+            finder.find_spec('klar_first').origin
+
+        (tmp_path / 'klar_second.ini').write_text('[section]\nkey = 2\n')
+        os.utime(str(tmp_path), ns=(0, 0))
+        from klar_second import config
+        assert config['section']['key'] == '2'
+        assert finder.find_spec('klar_missing') is None
+
+    def test_data_import_cache(self, tmp_path, monkeypatch):
+        monkeypatch.syspath_prepend(str(tmp_path))
+        (tmp_path / 'klar_data.json').write_text('{"quote": "\\"\\"\\""}')
+        (tmp_path / 'klar_conf.yaml').write_text('db:\n  port: 27017\n')
+
+        import klar_data
+        assert 'quote' not in vars(klar_data)
+        assert klar_data.quote == '"""'
+        assert klar_data.root == {'quote': '"""'}
+        cache = tmp_path / '__pycache__' / 'klar_data.json.pickle'
+        assert cache.exists()
+
+        from klar.importers import load_data
+        assert load_data(str(tmp_path / 'klar_data.json'), None) == \
+            {'quote': '"""'}
+
+        from klar_conf import db
+        assert db == {'port': 27017}
+
+    def test_data_import_names(self, tmp_path, monkeypatch):
+        monkeypatch.syspath_prepend(str(tmp_path))
+        (tmp_path / 'klar_names.json').write_text('{"a": 1, "_b": 2}')
+        (tmp_path / 'klar_star.json').write_text('{"c": 3}')
+
+        import klar_names
+        assert 'a' in dir(klar_names) and 'root' in dir(klar_names)
+        namespace = {}
+        exec('from klar_star import *', namespace)
+        assert namespace['c'] == 3 and namespace['root'] == {'c': 3}
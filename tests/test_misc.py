@@ -15,3 +15,57 @@ def test_cached_property():
     l = Lazy()
     assert l.count == 1
     assert l.count == 1
+
+
+def run_python(*args):
+    import os
+    import sys
+    import subprocess
+    import klar
+    root = os.path.dirname(os.path.dirname(os.path.abspath(klar.__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    return subprocess.run([sys.executable] + list(args), env=env, cwd=root,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+
+
+def test_lazy_imports():
+    heavy = ['jsonschema', 'cgi', 'http.client', 'mimetypes', 'zlib',
+             'random', 'hashlib', 'logging', 'yaml', 'pystache', 'jinja2']
+    out = run_python('-c', 'import sys, klar; print(" ".join(m for m in %r '
+                     'if m in sys.modules))' % heavy).stdout
+    assert out.split() == []
+
+
+def test_import_time_budget():
+    import os
+    budget = int(os.environ.get('KLAR_IMPORT_BUDGET_US', 100000))
+    err = run_python('-X', 'importtime', '-c', 'import klar').stderr
+    cumulative = [int(line.split('|')[1]) for line in err.splitlines()
+                  if line.split('|')[-1].strip() == 'klar']
+    assert cumulative and cumulative[0] < budget
+
+
+def test_benchmark_scenarios(tmpdir):
+    baseline = str(tmpdir.join('baseline.json'))
+    result = run_python('benchmarks/run.py', '-d', '0.01', '-b', baseline,
+                        '--save')
+    assert 'template' in result.stdout
+    with open(baseline) as fp:
+        import json
+        scenarios = json.load(fp)['scenarios']
+    assert scenarios['routing_1000']['ops'] > 0
+
+    import sys
+    import os
+    sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+    try:
+        from benchmarks.run import compare
+    finally:
+        sys.path.pop(0)
+    slower = {'routing_10': {'ops': 70, 'alloc_bytes': 100},
+              'injection': {'ops': 100, 'alloc_bytes': 130}}
+    base = {'routing_10': {'ops': 100, 'alloc_bytes': 100},
+            'injection': {'ops': 100, 'alloc_bytes': 100}}
+    assert compare(slower, base, 0.2) == ['routing_10', 'injection']
+    assert compare(slower, base, 0.5) == []
@@ -31,3 +31,133 @@ class TestProvider:
         assert str(p.bar) == 'baz'
         del p.bar
         assert str(p.bar) == 'foo'
+
+    def test_check(self):
+        import pytest
+        from klar import DependencyError
+        p = Provider()
+        p.register('a', lambda b: b)
+        p.register('b', lambda c, d=1: c)
+        with pytest.raises(DependencyError):
+            p.check()
+
+        p.register('c', lambda a: a)
+        with pytest.raises(DependencyError) as e:
+            p.check()
+        assert 'a -> b -> c -> a' in str(e.value)
+
+        p.register('c', lambda: 'c')
+        assert p.check() == {'a': ['b'], 'b': ['c'], 'c': []}
+
+    def test_warmup(self):
+        import threading
+        from klar import App
+        app = App()
+        built = []
+        # passed only when both are built at the same time
+        both = threading.Barrier(2, timeout=5)
+
+        @app.provide('db')
+        def db(config):
+            both.wait()
+            built.append('db')
+            return 'db'
+
+        @app.provide('search')
+        def search():
+            both.wait()
+            built.append('search')
+            return 'search'
+
+        @app.provide('user', on_request=True)
+        def user(db, req):
+            return 'user'
+
+        timings = app.warmup()
+        assert sorted(built) == ['db', 'search']
+        assert 'user' not in timings and 'req' not in timings
+        assert timings['db'] > 0
+        assert app.provider.accessed('config')
+
+    def test_pool(self):
+        import threading
+        from klar import App
+        from request import get
+
+        class FakeConnection:
+            opened = []
+
+            def __init__(self):
+                self.healthy = True
+                self.closed = False
+                FakeConnection.opened.append(self)
+
+            def close(self):
+                self.closed = True
+
+        app = App()
+        app.provide('db', FakeConnection,
+                    pool={'size': 1, 'timeout': 0.05,
+                          'check': lambda conn: conn.healthy})
+        entered = threading.Event()
+        leave = threading.Event()
+
+        @app.get('/query')
+        def query(db):
+            return str(FakeConnection.opened.index(db))
+
+        @app.get('/slow')
+        def slow(db):
+            entered.set()
+            leave.wait(1)
+            return 'slow'
+
+        assert get(app, '/query')['body'] == '0'
+        assert get(app, '/query')['body'] == '0'
+        assert app.provider.__pools__['db'].stats()['idle'] == 1
+
+        FakeConnection.opened[0].healthy = False
+        assert get(app, '/query')['body'] == '1'
+        assert FakeConnection.opened[0].closed
+
+        thread = threading.Thread(target=get, args=(app, '/slow'))
+        thread.start()
+        entered.wait(1)
+        res = get(app, '/query')
+        assert res['status'] == '503 Service Unavailable'
+        leave.set()
+        thread.join()
+        assert get(app, '/query')['body'] == '1'
+        assert app.provider.__pools__['db'].stats()['exhausted'] == 1
+
+    def test_pool_lease_outlives_response(self):
+        from klar import App
+        from request import get
+        app = App()
+        app.provide('db', object, pool={'size': 1, 'timeout': 1})
+        pool = app.provider.__pools__['db']
+        seen = []
+
+        def audit(db):
+            seen.append(('deferred', db, pool.stats()['leased']))
+
+        @app.on('visit', background=True)
+        def visit(db):
+            seen.append(('background', db, pool.stats()['leased']))
+
+        @app.get('/')
+        def index(db, res, emitter):
+            res.defer(audit, db=db)
+            emitter.emit('visit')
+            return 'ok'
+
+        response = app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+                        'QUERY_STRING': ''}, lambda status, headers: None)
+        assert list(response) == [b'ok']
+        # the response still holds db, the listener waits for it
+        assert pool.stats()['leased'] == 1
+        response.close()
+        app.provider.workers.join()
+        db = seen[0][1]
+        assert seen == [('deferred', db, 1), ('background', db, 1)]
+        assert pool.stats()['leased'] == 0
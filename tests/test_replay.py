@@ -0,0 +1,82 @@
+import json
+from klar import App
+from klar.cli import main
+from klar.replay import load, replay, diff, format_diff
+from request import get, json_request, form_request
+
+
+def make_app(fail=False):
+    app = App()
+
+    @app.get('/items/<id>')
+    def show(id: int):
+        if fail and id == 2:
+            return 404, 'gone'
+        return {'id': id}
+
+    @app.post('/login')
+    def login(body):
+        return 'ok'
+
+    return app
+
+
+app = make_app(fail=True)
+
+
+def test_record(tmpdir):
+    filename = str(tmpdir.join('traffic.jsonl'))
+    app = make_app()
+    recorder = app.record(filename)
+    assert get(app, '/items/1', {'token': 'abc', 'q': 'x'},
+               headers={'Authorization': 'Bearer abc', 'Accept': '*/*'}
+               )['body'] == '{"id": 1}'
+    res = json_request(app=app, path='/login',
+                       body={'user': 'z', 'password': 'p', 'nested': [
+                           {'api_key': 'k'}]})
+    assert res['body'] == 'ok'
+    form_request(app, '/login', {'user': 'z', 'secret': 's'},
+                 method='POST')
+    recorder.flush()
+
+    first, second, third = load(filename)
+    assert first['method'] == 'GET' and first['path'] == '/items/1'
+    assert first['route'] == '/items/<id>'
+    assert first['status'] == 200 and first['size'] == 9
+    assert first['latency'] >= 0
+    assert 'token=%5Bredacted%5D' in first['query'] and 'q=x' in first['query']
+    assert first['headers']['Authorization'] == '[redacted]'
+    assert first['headers']['Accept'] == '*/*'
+    assert json.loads(second['body']) == {
+        'user': 'z', 'password': '[redacted]',
+        'nested': [{'api_key': '[redacted]'}]}
+    assert 'secret=%5Bredacted%5D' in third['body']
+
+    results = replay(filename, app=make_app(), speed=None)
+    report = diff(results)
+    assert report['requests'] == 3 and report['mismatches'] == []
+    assert report['routes']['/items/<id>']['replayed']['p50'] is not None
+
+    results = replay(filename, app=make_app(fail=True), speed=1000)
+    assert [r['replayed']['status'] for r in results] == [200, 200, 200]
+
+
+def test_replay_cli(tmpdir, capsys):
+    filename = str(tmpdir.join('traffic.jsonl'))
+    recorded = make_app()
+    recorder = recorded.record(filename)
+    for id in (1, 2, 3):
+        get(recorded, '/items/%s' % id)
+    recorder.flush()
+
+    assert main(['replay', filename, 'test_replay:app', '--speed', '0',
+                 '--json']) == 1
+    report = json.loads(capsys.readouterr().out)
+    assert report['mismatches'] == [{'method': 'GET', 'path': '/items/2',
+                                     'recorded': 200, 'replayed': 404}]
+    assert 'status mismatches 1' in format_diff(report)
+
+    assert main(['bench', 'test_replay:app', '--replay', filename,
+                 '-n', '6', '--json']) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report['statuses'] == {'200': 4, '404': 2}